@@ -121,9 +121,10 @@ def main():
     ca = CA2D(25, 25)
     frames = ca.run(100)
 
-    frames = mp4.scale_up(frames, 25)
-    frames = mp4.binary2rgb(frames)
+    # Scaling and coloring happen one frame at a time as the video is written
     video = mp4.mp4('life.mp4', frames, FRAME_RATE)
+    video.scale_up(25)
+    video.binary2rgb()
     video.make()
     
 
@@ -145,11 +145,8 @@ def export_field(field: list) -> None:
     png.RGB('vector_field.png', data, depth = BIT_DEPTH).make()
 
 
-def main() -> None:
-    field = make_field()
-    frames = []
-    particles = [particle() for _ in range(MAX_NUM_PARTICLES)]
-
+def frames(particles: list):
+    # Frames are drawn one at a time, the video writer consumes each before the next is made
     for _ in range(NUM_FRAMES):
 
         if _ % NUM_FRAMES // 10 == 0:
@@ -161,11 +158,18 @@ def main() -> None:
             p.update()
             frame = p.draw(frame)
 
-        frames.append(frame)
+        yield frame
 
     print('100%')
+
+
+def main() -> None:
+    field = make_field()
+    particles = [particle() for _ in range(MAX_NUM_PARTICLES)]
+
     export_field(field)
-    mp4.mp4(FILENAME, frames, FPS).make()
+    # Encoding runs on a writer thread while the next frame is drawn
+    mp4.mp4(FILENAME, frames(particles), FPS, background=True).make()
 
 
 if __name__ == '__main__':
@@ -1,9 +1,12 @@
 # Extension of 2d_grapher.py to include time as a third dimension
 
+import expression
 import mp4generator as mp4
+import quadtree
 import time
 import math
-import sys
+import numpy as np
+from functools import partial
 
 FILENAME = "animations/circles.mp4"
 
@@ -21,9 +24,14 @@ CENTER = 0
 GRAPH_COLOR = (255, 255, 255)
 BG_COLOR = (46, 102, 130)
 
-def f(x, y, t: float) -> bool:
+# g as text (see expression.py), used instead of g below when set. The same curve as g:
+# 'sum((-1)^(n+1) * sin(2*pi*n*x) / (pi*n), n, 1, 1 + floor((1 - cos(pi*t)^2) / 0.0025)) - y'
+FORMULA = None
+
+def g(x, y, t: float):
     '''
     t: [0, 1]
+    x and y can be floats or NumPy arrays
     '''
     # t = (t * 8) - 4
     # t = math.cos(2 * math.pi * t)
@@ -33,18 +41,27 @@ def f(x, y, t: float) -> bool:
     sum = 0
 
     for n in range(1, k + 1):
-        sum += (math.pow(-1, n+1) * math.sin(2 * math.pi * n * x)) / (math.pi * n)
+        sum += (math.pow(-1, n+1) * np.sin(2 * math.pi * n * x)) / (math.pi * n)
+
+    return sum - y
+
+def render_frame(frame_number: int, frame_width: int, frame_height: int) -> np.ndarray:
+    # Each frame only depends on its number, so frames can be rendered in parallel
+    t = frame_number * DT
+    function = g if FORMULA is None else expression.compile_kernel(FORMULA, ('x', 'y', 't'))
+
+    if frame_number % 50 == 0:
+        print(f"Frame {frame_number}")
 
-    value = sum - y
-    value = abs(value - CENTER)
+    def g_pixels(px, py):
+        x = X_MAX * px / frame_width + X_MIN * (frame_width - px) / frame_width
+        y = Y_MAX * py / frame_height + Y_MIN * (frame_height - py) / frame_height
+        return function(x, y, t) - CENTER
 
-    return value < NBHD
+    # Only the pixels near the curve are evaluated
+    curve = quadtree.rasterize(g_pixels, frame_width, frame_height, -NBHD, NBHD)
 
-def bool2rgb(value: bool) -> tuple:
-    if value:
-        return GRAPH_COLOR
-    else:
-        return BG_COLOR
+    return np.where(curve[..., None], GRAPH_COLOR, BG_COLOR).astype(np.uint8)
 
 def main():
 
@@ -53,36 +70,12 @@ def main():
 
     num_frames = int(1 / DT)
 
-    frames = []
-
     sys_time = time.time()
-    print(f"Generating {num_frames} frames with resolution {frame_width}x{frame_height}...")
-
-    for frame_number in range(num_frames):
-        frame = []
-        t = frame_number * DT
-
-        if frame_number % 50 == 0:
-            print(f"Frame {frame_number}/{num_frames}")
+    print(f"Generating and rendering {num_frames} frames with resolution {frame_width}x{frame_height}...")
 
-        for y in range(frame_height):
-            row = []
-
-            for x in range(frame_width):
-                x_val = X_MAX * x / frame_width + X_MIN * (frame_width - x) / frame_width
-                y_val = Y_MAX * y / frame_height + Y_MIN * (frame_height - y) / frame_height
-
-                row.append(bool2rgb(f(x_val, y_val, t)))
-
-            frame.append(row)
-
-        frames.append(frame)
-    
-    print(f"{sys.getsizeof(frames)} bytes worth of frames generated in {time.time() - sys_time} seconds")
-
-    sys_time = time.time()
-    print("Rendering video...")
-    video = mp4.mp4(FILENAME, frames, FPS)
+    # Frames render on every core, encoding runs on a writer thread
+    frames = mp4.render_frames(partial(render_frame, frame_width=frame_width, frame_height=frame_height), num_frames)
+    video = mp4.mp4(FILENAME, frames, FPS, background=True)
     video.make()
     print(f"Video rendered in {time.time() - sys_time} seconds")
 
@@ -0,0 +1,475 @@
+# Benchmarks for the encoders, renderers and simulations
+#
+#   python benchmark.py                         run every case, save to benchmark.json
+#   python benchmark.py -o new.json png_ mp4_   only run the cases starting with png_ or mp4_
+#   python benchmark.py --quick                 smaller inputs, for a quick check
+#   python benchmark.py --compare old.json new.json
+#
+# Every case runs in its own fresh process so the peak RSS belongs to that case alone.
+# The best of --repeat runs is kept. Cases whose dependencies are missing are skipped.
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Fractional slowdown (or memory growth) that counts as a regression in --compare
+THRESHOLD = 0.1
+
+CASES = {}
+
+
+def case(name: str):
+    '''Registers a benchmark case
+    The case is called with a scale (1 normally, smaller with --quick) and does its setup,
+    then returns (run, pixels, frames) where only run() is timed'''
+
+    def register(function):
+        CASES[name] = function
+        return function
+    return register
+
+
+def _script(path: str):
+    # The scripts are not importable by name (plots/1dca.py, plots/2d_grapher.py, ...), so load them by path
+    name = '_bench_' + os.path.splitext(os.path.basename(path))[0]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+# The temporary directory of the case being measured, see _measure
+_scratch = None
+
+
+def _output(suffix: str) -> str:
+    return os.path.join(_scratch, 'out' + suffix)
+
+
+def _image(width: int, height: int, depth: int, channels: int) -> list:
+    # A smooth gradient with some noise, roughly what the plots produce
+    top = 2 ** depth - 1
+    rng = random.Random(0)
+    image = []
+    for y in range(height):
+        row = []
+        for x in range(width):
+            value = int(top * (x + y) / (width + height - 2)) ^ rng.randrange(4)
+            row.append(value if channels == 1 else (value, top - value, (value * 7) & top))
+        image.append(row)
+    return image
+
+
+# ______________________________________________________________________________________________________________________
+# PNG encoding
+
+
+def _png_case(color: str, depth: int, compression: bool, size: int):
+    def setup(scale: int):
+        import pngenerator as png
+
+        side = max(16, size // scale)
+        encoder = png.Grayscale if color == 'gray' else png.RGB
+        data = _image(side, side, depth, 1 if color == 'gray' else 3)
+        filename = _output('.png')
+
+        def run():
+            encoder(filename, data, depth=depth, compression=compression).make()
+
+        return run, side * side, 0
+    return setup
+
+
+for _color in ('gray', 'rgb'):
+    for _depth in (8, 16):
+        for _compression in (False, True):
+            for _size in (256, 1024):
+                case(f"png_{_color}{_depth}_{'zlib' if _compression else 'raw'}_{_size}")(
+                    _png_case(_color, _depth, _compression, _size))
+
+
+# ______________________________________________________________________________________________________________________
+# mp4 writing
+
+
+@case('mp4_write_rgb')
+def _mp4_write(scale: int):
+    import numpy as np
+    import mp4generator as mp4
+
+    side, count = 512 // scale, 120 // scale
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 256, (side, side, 3), dtype=np.uint8) for _ in range(count)]
+    filename = _output('.mp4')
+
+    def run():
+        mp4.mp4(filename, frames, 24.0).make()
+
+    return run, side * side * count, count
+
+
+@case('mp4_scale_binary')
+def _mp4_scale_binary(scale: int):
+    import mp4generator as mp4
+
+    side, factor, count = 25, 16 // scale, 100 // scale
+    rng = random.Random(0)
+    frames = [[[rng.randint(0, 1) for _ in range(side)] for _ in range(side)] for _ in range(count)]
+    filename = _output('.mp4')
+
+    def run():
+        video = mp4.mp4(filename, frames, 8)
+        video.scale_up(factor)
+        video.binary2rgb()
+        video.make()
+
+    return run, (side * factor) ** 2 * count, count
+
+
+# ______________________________________________________________________________________________________________________
+# Simulations
+
+
+@case('ca1d_generate')
+def _ca1d(scale: int):
+    ca1d = _script('plots/1dca.py')
+
+    side = 512 // scale
+
+    def run():
+        ca1d.CA(30, side, side, ca1d.SEED_TYPE.CENTER).generate()
+
+    return run, side * side, 0
+
+
+@case('ca1d_sweep')
+def _ca1d_sweep(scale: int):
+    ca1d = _script('plots/1dca.py')
+
+    side = 512 // scale
+    seeds = ca1d.seed_batch(side)
+
+    def run():
+        for _ in ca1d.sweep(range(256), seeds, side):
+            pass
+
+    return run, 256 * len(seeds) * side * side, 0
+
+
+@case('ca1d_totalistic')
+def _ca1d_totalistic(scale: int):
+    ca1d = _script('plots/1dca.py')
+
+    side = 256 // scale
+    seeds = ca1d.seed_batch(side)
+
+    def run():
+        # Every 3 state, radius 1 totalistic rule
+        for _ in ca1d.sweep(range(3 ** 7), seeds, side, states=3, totalistic=True):
+            pass
+
+    return run, 3 ** 7 * len(seeds) * side * side, 0
+
+
+@case('ca2d_update')
+def _ca2d(scale: int):
+    ca2d = _script('animations/2dca.py')
+
+    side, steps = 64 // scale, 10
+    random.seed(0)
+    ca = ca2d.CA2D(side, side)
+
+    def run():
+        for _ in range(steps):
+            ca.update()
+
+    return run, side * side * steps, steps
+
+
+@case('vector_field_step')
+def _vector_field(scale: int):
+    field = _script('animations/vector_field.py')
+
+    steps = 100 // scale
+    random.seed(0)
+    particles = [field.particle() for _ in range(field.MAX_NUM_PARTICLES)]
+
+    def run():
+        for _ in range(steps):
+            for p in particles:
+                p.update()
+
+    return run, 0, steps
+
+
+# ______________________________________________________________________________________________________________________
+# Renderers
+
+
+@case('gaussian_blur')
+def _gaussian_blur(scale: int):
+    grapher = _script('plots/2d_grapher.py')
+
+    side = 128 // scale
+    plot = _image(side, side, 8, 1)
+
+    def run():
+        grapher.gaussian_blur(plot, 2)
+
+    return run, side * side, 0
+
+
+@case('average_blur')
+def _average_blur(scale: int):
+    grapher = _script('plots/2d_grapher.py')
+
+    side = 256 // scale
+    plot = _image(side, side, 8, 1)
+
+    def run():
+        grapher.average_blur(plot, 2)
+
+    return run, side * side, 0
+
+
+@case('blur_gaussian')
+def _blur_gaussian(scale: int):
+    import blur
+
+    side = 1024 // scale
+    plot = _image(side, side, 8, 1)
+
+    def run():
+        blur.gaussian_blur(plot, 8)
+
+    return run, side * side, 0
+
+
+@case('blur_box')
+def _blur_box(scale: int):
+    import blur
+
+    side = 1024 // scale
+    plot = _image(side, side, 8, 1)
+
+    def run():
+        blur.box_blur(plot, 8)
+
+    return run, side * side, 0
+
+
+@case('quadtree_curve')
+def _quadtree_curve(scale: int):
+    import numpy as np
+    import quadtree
+
+    side = 2048 // scale
+
+    def curve(px, py):
+        x, y = px / side * 8 - 4, py / side * 8 - 4
+        return np.sin(x * y) + np.cos(x + y) - 0.5
+
+    def run():
+        quadtree.rasterize(curve, side, side, -0.01, 0.01)
+
+    return run, side * side, 0
+
+
+@case('domain_color')
+def _domain_color(scale: int):
+    domain = _script('plots/domain_color.py')
+
+    side = 512 // scale
+
+    def run():
+        for _ in domain.rows(side, side):
+            pass
+
+    return run, side * side, 0
+
+
+@case('expression_kernel')
+def _expression_kernel(scale: int):
+    import numpy as np
+    import expression
+
+    side = 2048 // scale
+    x = np.linspace(-8, 8, side)[None, :]
+    y = np.linspace(-8, 8, side)[:, None]
+
+    def run():
+        # Compiled each time through the cache, like the renderers do
+        expression.compile_kernel('sin(x)^2 + cos(y)^2 + sin(x) * cos(y) - x * y')(x, y)
+
+    return run, side * side, 0
+
+
+# ______________________________________________________________________________________________________________________
+
+
+def _peak_rss() -> float:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _measure(name: str, scale: int, repeat: int) -> dict:
+    '''Runs one case, in a worker process of its own, with its output files in a temporary directory removed afterwards'''
+
+    global _scratch
+    with tempfile.TemporaryDirectory(prefix='bench_') as _scratch:
+        return _measure_case(name, scale, repeat)
+
+
+def _measure_case(name: str, scale: int, repeat: int) -> dict:
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            run, pixels, frames = CASES[name](scale)
+    except ImportError as error:
+        return {'skipped': str(error)}
+
+    seconds = math.inf
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run()
+                seconds = min(seconds, time.perf_counter() - start)
+    except Exception as error:
+        # One broken case shouldn't throw away the rest of the run
+        return {'failed': f'{type(error).__name__}: {error}'}
+
+    result = {'seconds': seconds, 'peak_rss_mb': _peak_rss()}
+    if pixels:
+        result['pixels'] = pixels
+        result['pixels_per_second'] = pixels / seconds
+    if frames:
+        result['frames'] = frames
+        result['frames_per_second'] = frames / seconds
+    return result
+
+
+def run(names: list, scale: int = 1, repeat: int = 3) -> dict:
+    '''Runs the named cases and returns the results with a description of the machine'''
+
+    results = {}
+    for name in names:
+        # A fresh spawned process per case, so neither imports nor memory leak between cases
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as executor:
+            results[name] = executor.submit(_measure, name, scale, repeat).result()
+        print(f'{name:28} {_describe(results[name])}')
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'scale': scale,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def _describe(result: dict) -> str:
+    if 'skipped' in result:
+        return f"skipped ({result['skipped']})"
+    if 'failed' in result:
+        return f"failed ({result['failed'].splitlines()[0]})"
+
+    text = f"{result['seconds']:9.4f} s"
+    if 'pixels_per_second' in result:
+        text += f"  {result['pixels_per_second'] / 1e6:9.3f} Mpx/s"
+    if 'frames_per_second' in result:
+        text += f"  {result['frames_per_second']:9.2f} frames/s"
+    return text + f"  {result['peak_rss_mb']:8.1f} MB"
+
+
+def _throughput(result: dict) -> float:
+    if 'pixels_per_second' in result:
+        return result['pixels_per_second']
+    if 'frames_per_second' in result:
+        return result['frames_per_second']
+    return 1 / result['seconds']
+
+
+def compare(old: dict, new: dict, threshold: float = THRESHOLD) -> list:
+    '''Compares two runs case by case and returns the names of the cases that regressed
+    A case regresses when its throughput falls, or its peak RSS grows, by more than threshold'''
+
+    if old.get('scale') != new.get('scale'):
+        print(f"Warning: comparing runs at different scales ({old.get('scale')} and {new.get('scale')})")
+
+    regressions = []
+    print(f"{'case':28} {'old':>12} {'new':>12} {'speed':>8} {'rss':>8}")
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before, after = old['results'][name], new['results'][name]
+        if 'seconds' not in before or 'seconds' not in after:
+            print(f'{name:28} not measured in both runs')
+            continue
+
+        speed = _throughput(after) / _throughput(before)
+        memory = after['peak_rss_mb'] / before['peak_rss_mb']
+        flag = ''
+        if speed < 1 - threshold or memory > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+
+        print(f"{name:28} {before['seconds']:10.4f} s {after['seconds']:10.4f} s {speed:7.2f}x {memory:7.2f}x{flag}")
+
+    for name in sorted(set(old['results']) ^ set(new['results'])):
+        print(f"{name:28} only in {'old' if name in old['results'] else 'new'}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the encoders, renderers and simulations')
+    parser.add_argument('cases', nargs='*', help='only run the cases starting with one of these prefixes')
+    parser.add_argument('-o', '--output', default='benchmark.json', help='where to save the results')
+    parser.add_argument('--quick', action='store_true', help='smaller inputs')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the best is kept')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two saved runs')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='fractional change that counts as a regression')
+    args = parser.parse_args()
+
+    if args.list:
+        print('\n'.join(CASES))
+        return
+
+    if args.compare:
+        runs = []
+        for filename in args.compare:
+            with open(filename) as file:
+                runs.append(json.load(file))
+
+        regressions = compare(*runs, threshold=args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+            sys.exit(1)
+        return
+
+    names = [name for name in CASES if not args.cases or name.startswith(tuple(args.cases))]
+    results = run(names, 4 if args.quick else 1, args.repeat)
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f'Saved to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+# Compiles formula strings into vectorized NumPy functions
+#
+#   f = expression.compile_kernel('tan(x) - y')
+#   f(x_grid, y_grid)
+#
+# Formulas use Python syntax over the variables x, y, z and t (^ also means power):
+#   + - * / ** % ^, numbers (1j for i), pi, e, inf
+#   sin cos tan asin acos atan atan2 sinh cosh tanh exp log log10 sqrt abs floor ceil
+#   real imag conj arg min max hypot
+#   sum(term, n, start, stop) - the finite sum of term for n = start, ..., stop (both included)
+#
+# The formula is parsed into a graph where equal subexpressions are one node (a + b and b + a included)
+# and constant parts are folded. One Python function is generated from it: each node is computed once,
+# parts of a sum that do not depend on its counter are computed before the loop, and a temporary array
+# that nothing else needs is overwritten by the next operation instead of allocating a new one.
+# Kernels are cached by formula.
+
+import ast
+import builtins
+import functools
+import math
+import numpy as np
+
+VARIABLES = ('x', 'y', 'z', 't')
+
+CONSTANTS = {'pi': math.pi, 'e': math.e, 'inf': math.inf}
+
+# name -> (NumPy function, number of arguments, whether the result has the argument's dtype so it can be done in place)
+FUNCTIONS = {
+    'sin': ('np.sin', 1, True), 'cos': ('np.cos', 1, True), 'tan': ('np.tan', 1, True),
+    'asin': ('np.arcsin', 1, True), 'acos': ('np.arccos', 1, True), 'atan': ('np.arctan', 1, True),
+    'sinh': ('np.sinh', 1, True), 'cosh': ('np.cosh', 1, True), 'tanh': ('np.tanh', 1, True),
+    'exp': ('np.exp', 1, True), 'log': ('np.log', 1, True), 'log10': ('np.log10', 1, True), 'sqrt': ('np.sqrt', 1, True),
+    'floor': ('np.floor', 1, True), 'ceil': ('np.ceil', 1, True), 'conj': ('np.conj', 1, True),
+    'abs': ('np.abs', 1, False), 'real': ('np.real', 1, False), 'imag': ('np.imag', 1, False), 'arg': ('np.angle', 1, False),
+    'atan2': ('np.arctan2', 2, True), 'hypot': ('np.hypot', 2, True), 'min': ('np.minimum', 2, True), 'max': ('np.maximum', 2, True),
+}
+
+OPERATORS = {
+    ast.Add: ('+', 'np.add'), ast.Sub: ('-', 'np.subtract'), ast.Mult: ('*', 'np.multiply'),
+    ast.Div: ('/', 'np.true_divide'), ast.Pow: ('**', 'np.power'), ast.Mod: ('%', 'np.remainder'),
+}
+
+_COMMUTATIVE = ('+', '*')
+
+# Functions that can hand back a view of their argument (np.real of a real array is the array itself),
+# so their results are never overwritten in place
+_VIEWS = ('real', 'imag')
+
+
+def _empty(value):
+    # value with no elements and the same dtype, scalars are left as they are since NumPy promotes them by kind
+    if isinstance(value, np.ndarray) and value.ndim:
+        return value[(slice(0, 0),) * value.ndim]
+    return value
+
+def _fits(target, ufunc, a, b) -> bool:
+    # Whether target can hold ufunc(a, b): writable, with the result's shape and the dtype the ufunc resolves to
+    # (true_divide of integers is float64), found by running it on no elements
+    return (isinstance(target, np.ndarray) and target.flags.writeable
+            and target.shape == np.broadcast_shapes(np.shape(a), np.shape(b))
+            and ufunc(_empty(a), _empty(b)).dtype == target.dtype)
+
+def _binary(ufunc, a, b, reuse_a: bool, reuse_b: bool):
+    if reuse_a and _fits(a, ufunc, a, b):
+        return ufunc(a, b, out=a)
+    if reuse_b and _fits(b, ufunc, a, b):
+        return ufunc(a, b, out=b)
+    return ufunc(a, b)
+
+def _unary(ufunc, a, reuse: bool):
+    if reuse and isinstance(a, np.ndarray) and a.flags.writeable and a.dtype.kind in 'fc':
+        return ufunc(a, out=a)
+    return ufunc(a)
+
+def _shaped(result, *arguments):
+    # Constant (or partly constant) formulas still give one value per grid point
+    shape = np.broadcast_shapes(*map(np.shape, arguments))
+    if np.shape(result) != shape:
+        return np.broadcast_to(result, shape)
+    return result
+
+
+class _Node:
+    __slots__ = ('kind', 'name', 'children', 'free', 'uses', 'value')
+
+    def __init__(self, kind: str, name, children: tuple, free: frozenset, value=None):
+        self.kind = kind
+        self.name = name
+        self.children = children
+        self.free = free
+        self.uses = 0
+        self.value = value
+
+
+class _Parser:
+    # Builds the graph, one node per distinct subexpression
+
+    def __init__(self, variables: tuple):
+        self.variables = variables
+        self.nodes = {}
+        self.loops = []
+
+    def node(self, kind: str, name, children: tuple = (), value=None) -> _Node:
+        if kind == 'op' and name in _COMMUTATIVE:
+            children = tuple(sorted(children, key=id))
+
+        # Constants by repr, since -1.0 == -1 + 0j and 0.0 == -0.0 but they fold differently
+        key = (kind, name, repr(value) if kind == 'const' else None, tuple(map(id, children)))
+        if key not in self.nodes:
+            free = frozenset().union(*(child.free for child in children))
+            if kind == 'var':
+                free = frozenset([name])
+            elif kind == 'sum':
+                free = (children[0].free - {name}) | children[1].free | children[2].free
+
+            node = _Node(kind, name, children, free, value)
+            if not free and kind not in ('const', 'sum'):
+                # Nothing varies, work it out now
+                node = self.node('const', None, value=_fold(node))
+            self.nodes[key] = node
+
+        return self.nodes[key]
+
+    def parse(self, tree: ast.AST) -> _Node:
+        if isinstance(tree, ast.Expression):
+            return self.parse(tree.body)
+
+        if isinstance(tree, ast.Constant) and isinstance(tree.value, (int, float, complex)) and not isinstance(tree.value, bool):
+            # Integers become floats, so (-1) ** -n works like it does by hand
+            value = tree.value if isinstance(tree.value, complex) else float(tree.value)
+            return self.node('const', None, value=value)
+
+        if isinstance(tree, ast.Name):
+            if tree.id in self.loops or tree.id in self.variables:
+                return self.node('var', tree.id)
+            if tree.id in CONSTANTS:
+                return self.node('const', None, value=CONSTANTS[tree.id])
+            raise ValueError(f"Unknown name '{tree.id}'. Variables are {', '.join(self.variables)}.")
+
+        if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, (ast.USub, ast.UAdd)):
+            operand = self.parse(tree.operand)
+            return operand if isinstance(tree.op, ast.UAdd) else self.node('neg', None, (operand,))
+
+        if isinstance(tree, ast.BinOp) and type(tree.op) in OPERATORS:
+            return self.node('op', OPERATORS[type(tree.op)][0], (self.parse(tree.left), self.parse(tree.right)))
+
+        if isinstance(tree, ast.Call) and isinstance(tree.func, ast.Name) and not tree.keywords:
+            name, arguments = tree.func.id, tree.args
+
+            if name == 'sum':
+                if len(arguments) != 4 or not isinstance(arguments[1], ast.Name):
+                    raise ValueError('sum takes a term, a counter name, a start and a stop: sum(term, n, 1, 10)')
+                counter = arguments[1].id
+                if counter in self.variables or counter in CONSTANTS or counter.startswith('_') or counter == 'np':
+                    raise ValueError(f"'{counter}' can not be a sum's counter")
+                start, stop = self.parse(arguments[2]), self.parse(arguments[3])
+                self.loops.append(counter)
+                term = self.parse(arguments[0])
+                self.loops.pop()
+                return self.node('sum', counter, (term, start, stop))
+
+            if name in FUNCTIONS:
+                if len(arguments) != FUNCTIONS[name][1]:
+                    raise ValueError(f'{name} takes {FUNCTIONS[name][1]} argument(s)')
+                return self.node('call', name, tuple(self.parse(argument) for argument in arguments))
+
+            raise ValueError(f"Unknown function '{name}'")
+
+        raise ValueError(f'Unsupported expression: {ast.unparse(tree)}')
+
+
+def _fold(node: _Node):
+    children = [child.value for child in node.children]
+    with np.errstate(all='ignore'):
+        if node.kind == 'neg':
+            return -children[0]
+        # As NumPy values, so the folded constant is what the kernel would have computed (e.g. 1 / 0 is inf), for real and complex alike
+        children = [np.asarray(child) for child in children]
+        if node.kind == 'op':
+            return np.asarray(eval(f'a {node.name} b', {}, {'a': children[0], 'b': children[1]})).item()
+        return np.asarray(eval(FUNCTIONS[node.name][0], {'np': np})(*children)).item()
+
+
+class _Scope:
+    # The body of the function, or of one sum's loop
+
+    def __init__(self, parent=None, counter: str = None, depth: int = 0):
+        self.parent = parent
+        self.counter = counter
+        self.depth = depth
+        self.names = {}
+        self.lines = []
+
+    def owner(self, node: _Node):
+        # The innermost scope whose counter the node depends on (the function body if none)
+        scope = self
+        while scope.counter is not None and scope.counter not in node.free:
+            scope = scope.parent
+        return scope
+
+    def lookup(self, node: _Node):
+        scope = self
+        while scope is not None:
+            if id(node) in scope.names:
+                return scope.names[id(node)]
+            scope = scope.parent
+        return None
+
+
+class _Generator:
+
+    def __init__(self):
+        self.count = 0
+
+    def temporary(self) -> str:
+        self.count += 1
+        return f'_t{self.count}'
+
+    def operand(self, node: _Node, scope: _Scope, consumer: _Scope) -> tuple:
+        # The operand's name, and whether it may be overwritten: a temporary with no other use, made in the same loop
+        name = self.emit(node, scope)
+        reusable = (node.kind not in ('var', 'const') and not (node.kind == 'call' and node.name in _VIEWS)
+                    and node.uses == 1 and scope.owner(node) is consumer)
+        return name, reusable
+
+    def emit(self, node: _Node, scope: _Scope) -> str:
+        if node.kind == 'const':
+            # inf and nan have no literal, they are written as float('inf'), complex('(nan+nanj)')
+            if np.isfinite(node.value):
+                return repr(node.value)
+            return f'{type(node.value).__name__}({repr(node.value)!r})'
+        if node.kind == 'var':
+            return node.name
+
+        owner = scope.owner(node)
+        name = owner.lookup(node)
+        if name is not None:
+            return name
+
+        if node.kind == 'sum':
+            name = self.emit_sum(node, owner)
+        else:
+            operands = [self.operand(child, owner, owner) for child in node.children]
+            name = self.temporary()
+
+            if node.kind == 'neg':
+                code = f'_unary(np.negative, {operands[0][0]}, {operands[0][1]})'
+            elif node.kind == 'op':
+                (a, reuse_a), (b, reuse_b) = operands
+                if node.name == '**' and node.children[1].kind == 'const' and node.children[1].value == 2.0:
+                    code = f'_binary(np.multiply, {a}, {a}, {reuse_a}, False)'
+                elif node.name == '**' and node.children[1].kind == 'const' and node.children[1].value == 0.5:
+                    code = f'_unary(np.sqrt, {a}, {reuse_a})'
+                else:
+                    code = f"_binary({dict(OPERATORS.values())[node.name]}, {a}, {b}, {reuse_a}, {reuse_b})"
+            else:
+                function, _, in_place = FUNCTIONS[node.name]
+                if len(operands) == 1 and in_place:
+                    code = f'_unary({function}, {operands[0][0]}, {operands[0][1]})'
+                elif len(operands) == 2 and in_place:
+                    code = f'_binary({function}, {operands[0][0]}, {operands[1][0]}, {operands[0][1]}, {operands[1][1]})'
+                else:
+                    code = f"{function}({', '.join(operand for operand, _ in operands)})"
+
+            owner.lines.append(f'{name} = {code}')
+            for (operand, reusable) in operands:
+                if reusable:
+                    owner.lines.append(f'del {operand}')
+
+        owner.names[id(node)] = name
+        return name
+
+    def emit_sum(self, node: _Node, scope: _Scope) -> str:
+        term, start, stop = node.children
+        start_name = self.emit(start, scope)
+        stop_name = self.emit(stop, scope)
+
+        total = self.temporary()
+        body = _Scope(scope, node.name, scope.depth + 1)
+        term_name, reusable = self.operand(term, body, body)
+
+        scope.lines.append(f'{total} = 0.0')
+        scope.lines.append(f'for {node.name} in range(int({start_name}), int({stop_name}) + 1):')
+        scope.lines.extend('    ' + line for line in body.lines)
+        # The first pass makes the array, after that it is added to in place
+        scope.lines.append(f'    {total} = _binary(np.add, {total}, {term_name}, True, {reusable})')
+        return total
+
+
+def _count_uses(node: _Node, seen: set):
+    for child in node.children:
+        child.uses += 1
+        if id(child) not in seen:
+            seen.add(id(child))
+            _count_uses(child, seen)
+
+
+@functools.lru_cache(maxsize=256)
+def compile_kernel(text: str, variables: tuple = None):
+    '''Compiles a formula into a function of arrays (or numbers), taking the variables in the order given.
+    By default those are the ones the formula uses, in the order x, y, z, t. The result has the broadcast shape of the arguments.
+    The generated code is in the function's source attribute.'''
+
+    # ^ is swapped before parsing, as an operator of its own it would bind looser than + and -
+    tree = ast.parse(text.strip().replace('^', '**'), mode='eval')
+
+    if variables is None:
+        used = {name.id for name in ast.walk(tree) if isinstance(name, ast.Name)}
+        variables = tuple(name for name in VARIABLES if name in used)
+
+    root = _Parser(tuple(variables)).parse(tree)
+    _count_uses(root, set())
+    root.uses += 1
+
+    scope = _Scope()
+    result = _Generator().emit(root, scope)
+
+    arguments = ', '.join(variables)
+    source = '\n'.join([f'def kernel({arguments}):'] + ['    ' + line for line in scope.lines] + [f'    return _shaped({result}{", " if arguments else ""}{arguments})'])
+
+    namespace = {'np': np, '_binary': _binary, '_unary': _unary, '_shaped': _shaped}
+    exec(builtins.compile(source, f'<formula {text!r}>', 'exec'), namespace)
+
+    kernel = namespace['kernel']
+    kernel.source = source
+    kernel.__doc__ = text
+    return kernel
+
+
+def test_kernels():
+    # Kernels should match NumPy evaluating the same formula, and leave their arguments as they were
+    x = np.linspace(-3, 3, 7)[None, :]
+    y = np.linspace(-2, 2, 5)[:, None]
+    z = x + 1j * y
+    namespace = {'np': np, **CONSTANTS, **{name: eval(function, {'np': np}) for name, (function, _, _) in FUNCTIONS.items()}}
+
+    integers = np.arange(1, 8)[None, :], np.arange(-2, 3)[:, None]
+    formulas = ['tan(x) - y', 'sin(x)*sin(x) + cos(y)^2', '(x + y)**2 - sqrt(abs(x))', 'atan2(y, x) + hypot(x, y)',
+                'real(x) + 1 + y', 'real(z) * 3', 'imag(z) * 3 + 1', 'conj(z) * z + real(z)', 'exp(1j * x) * conj(1j * y)',
+                '2 * 1j + x', '(1 + 2j) * z', 'exp(1j * pi / 4) * z', '1j + 2 + z', 'z * (2 + 0j)', 'sqrt(-1 + 0j) * z', '-(3 - 1j) * z',
+                'inf * x + y', 'x / (0.0 * -1) + y']
+    # On integer arrays, where some results (true division) need a new float array
+    formulas = [(formula, (x, y, z)) for formula in formulas]
+    formulas += [(formula, integers + (None,)) for formula in ['(x*y)/(x+y)', 'x*x - y*y', '(x + y) * 3 / x + y', '(x - y) % 4 * 2']]
+
+    for formula, (x, y, z) in formulas:
+        kernel = compile_kernel(formula)
+        grid = {'x': x, 'y': y, 'z': z}
+        shape = np.broadcast_shapes(x.shape, y.shape)
+        arguments = {name: np.broadcast_to(grid[name], shape).copy() for name in kernel.__code__.co_varnames[:kernel.__code__.co_argcount]}
+        before = {name: value.copy() for name, value in arguments.items()}
+
+        with np.errstate(all='ignore'):
+            result = kernel(*arguments.values())
+            expected = eval(formula.replace('^', '**'), {**namespace, **before})
+
+        assert np.allclose(result, expected, equal_nan=True), f'{formula} differs'
+        for name, value in arguments.items():
+            assert (value == before[name]).all(), f'{formula} changed {name}'
+
+    print(f'{len(formulas)} kernels match and leave their arguments alone')
@@ -26,120 +26,326 @@ data =  [
         ]
 """
 
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from multiprocessing import shared_memory
+
 # pip install opencv-python
 import cv2
 import numpy as np
 
+import profiling
+
+
+# Frame stages work on one uint8 array at a time, so the mp4 class can apply them lazily as each frame is written
+
+BINARY_PALETTE = np.array([(0, 0, 0), (255, 255, 255)], dtype=np.uint8)
+
+
+def as_frame(frame) -> np.ndarray:
+    '''Converts a frame (list of lists, or array) to a uint8 array'''
+    return np.asarray(frame).astype(np.uint8, copy=False)
+
+
+def scale_frame(frame, factor: int) -> np.ndarray:
+    '''Scales up a single frame by an integer factor with nearest neighbour sampling
+    Each pixel is repeated through a broadcast (zero stride) view, which is copied once into the output'''
+
+    frame = as_frame(frame)
+    height, width = frame.shape[:2]
+    channels = frame.shape[2:]
+
+    view = np.broadcast_to(frame[:, None, :, None], (height, factor, width, factor) + channels)
+    return view.reshape((height * factor, width * factor) + channels)
+
+
+def binary_frame2rgb(frame) -> np.ndarray:
+    '''Converts a single frame of 0s and 1s into black and white RGB with a palette lookup'''
+    return np.take(BINARY_PALETTE, (as_frame(frame) != 0).view(np.uint8), axis=0)
+
 
 def scale_up(frames: list, factor: int) -> list:
     '''Scales up the size of frames by an integer factor
     The number of frames remains the same'''
 
-    scaled_frames = []
-    for frame in frames:
-        scaled_frame = []
-        for row in frame:
-            scaled_row = []
-            for pixel in row:
-                for _ in range(factor):
-                    scaled_row.append(pixel)
-            for _ in range(factor):
-                scaled_frame.append(scaled_row)
-        scaled_frames.append(scaled_frame)
-
-    return scaled_frames
+    return [scale_frame(frame, factor) for frame in frames]
 
 
 def binary2rgb(data: list) -> list:
-    '''Converts a list of lists of lists of 0s and 1s into a list of lists of lists of RGB tuples'''
+    '''Converts a list of lists of lists of 0s and 1s into a list of RGB frames'''
+
+    return [binary_frame2rgb(frame) for frame in data]
+
+
+# Parallel rendering: worker processes render frames straight into a ring of shared memory slots,
+# so frames are never pickled on their way back to the encoder
+
+_shm = None
+_ring = None
+
+
+def _attach(name: str, shape: tuple):
+    # Runs once in each worker process
+    global _shm, _ring
+    _shm = shared_memory.SharedMemory(name=name)
+    _ring = np.ndarray(shape, dtype=np.uint8, buffer=_shm.buf)
+
+
+def _render_into(render, index: int, slot: int) -> int:
+    frame = as_frame(render(index))
+    if frame.shape != _ring.shape[1:]:
+        raise ValueError(f'Invalid frame size {frame.shape} for frame {index}. Every frame must be {_ring.shape[1:]}.')
+
+    _ring[slot] = frame
+    return index
+
+
+def render_frames(render, num_frames: int, workers: int = None, slots: int = None):
+    '''Renders frames in a pool of processes and yields them in order, ready to be passed to mp4
+    render(frame_index) must return a frame, and be picklable (a module level function or functools.partial)
+    Frame 0 is rendered here to find the frame size, the rest are spread over the workers
+    which write into a ring of slots (default 2 per worker) in shared memory'''
+
+    if num_frames <= 0:
+        return
+
+    first = as_frame(render(0))
+    if num_frames == 1:
+        yield first
+        return
 
-    rgb_data = []
-    for frame in data:
-        rgb_frame = []
-        for row in frame:
-            rgb_row = []
-            for pixel in row:
-                if pixel == 0:
-                    rgb_row.append((0, 0, 0))
-                else:
-                    rgb_row.append((255, 255, 255))
-            rgb_frame.append(rgb_row)
-        rgb_data.append(rgb_frame)
+    workers = workers or os.cpu_count()
+    slots = slots or 2 * workers
+
+    shm = shared_memory.SharedMemory(create=True, size=slots * first.nbytes)
+    executor = ProcessPoolExecutor(workers, initializer=_attach, initargs=(shm.name, (slots,) + first.shape))
+    ring = np.ndarray((slots,) + first.shape, dtype=np.uint8, buffer=shm.buf)
+
+    try:
+        free = deque(range(slots))
+        pending = deque()
+        next_index = 1
+
+        def submit():
+            # Keep every free slot busy
+            nonlocal next_index
+            while free and next_index < num_frames:
+                slot = free.popleft()
+                pending.append((slot, executor.submit(_render_into, render, next_index, slot)))
+                next_index += 1
+
+        # The first submit forks the workers, so it happens before frame 0 goes out: once the caller has it,
+        # other threads (like mp4's writer) may be running, and forking then can deadlock the children
+        submit()
+        yield first
+
+        while pending:
+            # Wait for the oldest frame
+            slot, future = pending.popleft()
+            future.result()
+
+            # Copied out, so the slot can be reused while the encoder (maybe on another thread) holds the frame
+            yield ring[slot].copy()
+            free.append(slot)
+            submit()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        del ring
+        shm.close()
+        shm.unlink()
 
-    return rgb_data
 
 
 class mp4:
 
-    def __init__(self, filename: str, data: list, fps: float = 24.0):
+    def __init__(self, filename: str, data: list = None, fps: float = 24.0, background: bool = False, queue_size: int = 8):
+        '''data is a list of frames, or any iterable of frames (e.g. a generator) which is streamed one frame at a time.
+        Frames are lists of lists of (r, g, b) tuples, or arrays shaped H x W x 3.
+        Frames can also be fed one at a time with write(), or inside a with block.
+
+        With background = True, frames are encoded on a writer thread while the caller makes the next one.
+        At most queue_size frames wait in between, write() blocks when the queue is full.
+        Queued frames must not be modified afterwards.'''
+
         self.filename = filename
         self.fps = fps
         self.data = data
-        self.height = len(data[0])
-        self.width = len(data[0][0])
-
-    def make(self):
-        frames = np.array(self.data, ndmin=3)
-        print(frames.shape)
+        self.out = None
+        self.frames_written = 0
+        self.stages = []
+
+        self.background = background
+        self.queue = queue.Queue(queue_size)
+        self.thread = None
+        self.error = None
+
+        # The size of a streamed video is only known once its first frame arrives
+        if hasattr(data, '__getitem__') and len(data) > 0:
+            self.height = len(data[0])
+            self.width = len(data[0][0])
+        else:
+            self.height = None
+            self.width = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # While the block is already raising, its exception is the one to see, not a writer error it may have caused
+        if exc_type is None:
+            self.close()
+        else:
+            self._release()
+
+    def _open(self, shape: tuple):
+        profiling.log(shape)
+        self.height, self.width = shape[:2]
 
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(self.filename, fourcc, self.fps, (self.width, self.height))
-        
-        print(f'File opened: {out.isOpened()}')
+        self.out = cv2.VideoWriter(self.filename, fourcc, self.fps, (self.width, self.height))
+
+        profiling.log(f'File opened: {self.out.isOpened()}')
+
+    def _encode(self, frame):
+        with profiling.stage('frame.convert'):
+            frame = as_frame(frame)
+            for stage in self.stages:
+                frame = stage(frame)
+
+            if self.out is None:
+                self._open(frame.shape)
+            elif frame.shape[:2] != (self.height, self.width):
+                raise ValueError(f'Invalid frame size {frame.shape[:2]}. Every frame must be {self.height} x {self.width}.')
 
-        for frame in frames:
             # We'll convert the np array to hex BGR format
             # \0xBBGGRR
-            frame = np.array(frame).astype(np.uint8)
             frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-            out.write(frame)
 
-        out.release()
-        cv2.destroyAllWindows()
+        with profiling.stage('frame.write', frame.nbytes):
+            self.out.write(frame)
+        self.frames_written += 1
+
+    def _writer(self):
+        # Runs on the writer thread. cvtColor and VideoWriter.write release the GIL,
+        # so encoding overlaps with the caller rendering the next frame.
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+
+            # After an error, keep draining so a producer blocked on a full queue is let go
+            if self.error is None:
+                try:
+                    self._encode(frame)
+                except Exception as e:
+                    self.error = e
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, frame):
+        '''Writes one frame, opening the file with the size of the first frame'''
+
+        if not self.background:
+            self._encode(frame)
+            return
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._writer, name=f'mp4 writer ({self.filename})', daemon=True)
+            self.thread.start()
+
+        # Errors from the writer thread surface on the next write (or on close)
+        self._raise_error()
+
+        # Time spent blocked here means the writer thread is the bottleneck
+        with profiling.stage('frame.queue'):
+            self.queue.put(frame)
+
+    def _release(self):
+        # Stops the writer thread and closes the file
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+        if self.out is not None:
+            self.out.release()
+            cv2.destroyAllWindows()
+            self.out = None
+
+            profiling.log('File closed')
+
+    def close(self):
+        self._release()
+        self._raise_error()
 
-        print('File closed')
+    def make(self):
+        # The with block closes the file and stops the writer thread on errors too
+        with profiling.stage('mp4.make'), self:
+            frames = iter(self.data)
+            while True:
+                # Time spent making the frames, when data is a generator
+                with profiling.stage('frame.render'):
+                    frame = next(frames, None)
+                if frame is None:
+                    break
+                self.write(frame)
 
     
     def scale_up(self, factor: int = 2):
-        self.data = scale_up(self.data, factor)
+        '''Scales up every frame as it is written'''
+        self.stages.append(lambda frame: scale_frame(frame, factor))
+
+        if self.height is not None:
+            self.height *= factor
+            self.width *= factor
 
     def binary2rgb(self):
-        '''If the data is binary, converts it to RGB format'''
-        self.data = binary2rgb(self.data)
+        '''If the data is binary, converts every frame to RGB format as it is written'''
+        self.stages.append(binary_frame2rgb)
+
+
+def _test_rgb_frame(f: int, w: int, h: int, frames: int) -> list:
+    import math
+
+    frame = []
+    for i in range(h):
+        row = []
+        for j in range(w):
+            c = [1.0, 1.0, 1.0]
+            phs = float(j) / float(w) * 2.0 * math.pi
+            c[0] = (1 + math.cos(phs)) / 2
+            c[1] = (1 + math.cos(phs + 2 * math.pi / 3)) / 2
+            c[2] = (1 + math.cos(phs - 2 * math.pi / 3)) / 2
+
+            mag = float(f) / float(frames)
+            mag = 1.0 - 2 * abs(mag - 0.5)
+
+            for x in range(3):
+                c[x] = c[x] * mag * 255
+                c[x] = min(int(c[x]), 255)
+
+            row.append((c[0], c[1], c[2]))
+        frame.append(row)
+    print(f'Frame {f}')
+
+    return frame
 
 
 def test_rgb():
     print('Testing RGB')
 
-    import math
-
     w = 512
     h = 256
     frames = 100
-    data = []
-
-    for f in range(frames):
-        frame = []
-        for i in range(h):
-            row = []
-            for j in range(w):
-                c = [1.0, 1.0, 1.0]
-                phs = float(j) / float(w) * 2.0 * math.pi
-                c[0] = (1 + math.cos(phs)) / 2
-                c[1] = (1 + math.cos(phs + 2 * math.pi / 3)) / 2
-                c[2] = (1 + math.cos(phs - 2 * math.pi / 3)) / 2
-
-                mag = float(f) / float(frames)
-                mag = 1.0 - 2 * abs(mag - 0.5)
-
-                for x in range(3):
-                    c[x] = c[x] * mag * 255
-                    c[x] = min(int(c[x]), 255)
-
-                row.append((c[0], c[1], c[2]))
-            frame.append(row)
-        data.append(frame)
-        print(f'Frame {f}')
+
+    # Every frame only depends on its index, so they render in parallel
+    data = render_frames(partial(_test_rgb_frame, w=w, h=h, frames=frames), frames)
 
     f = mp4('test.mp4', data, fps = 60.0)
     f.make()
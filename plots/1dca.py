@@ -1,6 +1,10 @@
 from enum import Enum
+import os
+from functools import reduce
 import random
-from ricklib import pngenerator as png
+import numpy as np
+import macrocell
+import pngenerator as png
 
 # Create 1D Cellular Automata with every possible rule (0-255)
 
@@ -9,6 +13,15 @@ DIR = 'plots/1D_CA/'
 DEFAULT_WIDTH = 512
 DEFAULT_HEIGHT = 512
 
+# atlas() keeps one file open per rule, so rules are swept in chunks of at most this many to stay under the open file limit
+MAX_OPEN = 256
+
+# Cycle detection keeps the hashes of at most this many rows (a few MB), so it only finds cycles up to this period
+MAX_SEEN = 2**16
+
+# Binary digits to pixel values
+_DIGIT_TO_PIXEL = bytes.maketrans(b'01', bytes([0, 255]))
+
 class SEED_TYPE(Enum):
     RANDOM = 0
     CENTER = 1
@@ -17,9 +30,11 @@ class SEED_TYPE(Enum):
 
 class CA:
 
-    def __init__(self, rule: int, width: int = DEFAULT_WIDTH, height: int = DEFAULT_HEIGHT, seed_type: SEED_TYPE = SEED_TYPE.RANDOM):
+    def __init__(self, rule: int, width: int = DEFAULT_WIDTH, height: int = DEFAULT_HEIGHT, seed_type: SEED_TYPE = SEED_TYPE.RANDOM, detect_cycles: bool = True, detect_shifts: bool = False):
         # Initialize the Cellular Automata
         # rule: integer from 0-255 defining the rule
+        # detect_cycles: once a row repeats, the rest are copied from the cycle instead of simulated
+        # detect_shifts: also catch rows that repeat moved sideways (gliders), see packed_rows
 
         if rule < 0 or rule > 255 or not isinstance(rule, int):
             raise ValueError('Rule must be an integer from 0-255')
@@ -29,6 +44,28 @@ class CA:
         self.height = height
         self.data = []
         self.seed_type = seed_type
+        self.detect_cycles = detect_cycles
+        self.detect_shifts = detect_shifts
+        self.max_seen = MAX_SEEN
+
+        # Filled in by packed_rows (and so generate and write) when a cycle is found: row transient + k repeats
+        # row transient + k - period, moved shift cells to the right. None until then.
+        self.transient = None
+        self.period = None
+        self.shift = None
+
+        # Rows are packed into ints laid out like a 1 bit PNG row: the first cell in the highest bit,
+        # padded with zero bits to a whole byte. Those pad bits are the zero cell past the right edge.
+        self.row_bytes = (width + 7) // 8
+        self.pad = 8 * self.row_bytes - width
+        self.mask = ((1 << width) - 1) << self.pad
+
+        # For each (left, center) pair the rule is one of 0, right, not right or 1, see _step
+        self.terms = []
+        for pair in range(4):
+            outputs = (rule >> (2 * pair)) & 0b11
+            if outputs:
+                self.terms.append((pair >> 1, pair & 1, outputs))
 
     def _rule(self, left: int, center: int, right: int):
         # Apply the rule to the current cell
@@ -64,23 +101,160 @@ class CA:
 
         return new_row
 
-    def generate(self):
-        # Generate the Cellular Automata
-        self.data = [self._init_seed()]
+    def _pack(self, row: list) -> int:
+        return int(''.join(map(str, row)) or '0', 2) << self.pad
+
+    def _unpack(self, row: int) -> list:
+        # One 0 / 255 value per cell, converted in C by way of the binary digits
+        return list(bin(row | (1 << 8 * self.row_bytes))[3:3 + self.width].encode().translate(_DIGIT_TO_PIXEL))
+
+    def _packed_seed(self) -> int:
+        if self.seed_type == SEED_TYPE.RANDOM:
+            return random.getrandbits(self.width) << self.pad
+        return self._pack(self._init_seed())
+
+    def _step(self, row: int) -> int:
+        # The next generation of every cell at once. Cell i's left neighbour is the bit above it and its right neighbour
+        # the bit below, so shifting the row by one lines every cell up with a neighbour, with zeros past both edges.
+        left = row >> 1
+        right = (row << 1) & self.mask
+        states = (left ^ self.mask, left), (row ^ self.mask, row), (right ^ self.mask, right)
+
+        next_row = 0
+        for l, c, outputs in self.terms:
+            cells = states[0][l] & states[1][c]
+            if outputs == 0b11:
+                next_row |= cells
+            else:
+                next_row |= cells & states[2][outputs >> 1]
+        return next_row
+
+    def _edge_free(self, row: int) -> bool:
+        # Whether the step from row is the same as on an endless row of zeros: a cell just past either edge
+        # would stay dead there (neighbourhoods 001 and 100 on the edge cells, and 000 everywhere else)
+        if self.rule & 1:
+            return False
+        first = (row >> (8 * self.row_bytes - 1)) & 1
+        last = (row >> self.pad) & 1
+        return not (first and (self.rule >> 1) & 1) and not (last and (self.rule >> 4) & 1)
+
+    def _moved(self, row: int, cells: int):
+        # row moved cells to the right (negative: to the left), or None if a live cell would leave the row
+        if cells >= 0:
+            moved = row >> cells
+            return moved if moved << cells == row and not moved & ~self.mask else None
+        moved = row << -cells
+        return moved if not moved & ~self.mask else None
+
+    def packed_rows(self):
+        '''Yields the rows of the automaton as packed ints, see __init__.
+        With detect_cycles the hashes of the rows are kept, and once one comes back the rows of the cycle are checked
+        and copied from then on instead of simulated. The table is emptied whenever it holds max_seen hashes, so memory
+        stays bounded for rules that never repeat, and a cycle is found as long as its period is below max_seen. With detect_shifts a row that comes back moved sideways
+        counts too, as long as the pattern stayed clear of the edges, so it evolves as on an endless row. It is
+        carried on moving until it would reach an edge, where the simulation takes over again.'''
+
+        self.transient = self.period = self.shift = None
+        row = self._packed_seed()
+        generation = 0
+
+        # Hash of a row -> generation, hash of a row's shape (moved all the way right) -> generation, cells moved
+        seen = {}
+        shapes = {}
+        edge_free_since = 0
+
+        while generation < self.height:
+            candidate = None
+
+            if self.detect_cycles:
+                if len(seen) >= self.max_seen:
+                    seen.clear()
+                    shapes.clear()
+
+                key = hash(row)
+                if key in seen:
+                    candidate = seen[key], 0
+                elif self.detect_shifts and row:
+                    offset = (row & -row).bit_length() - 1 - self.pad
+                    shape = hash(row >> (offset + self.pad))
+                    if shape in shapes and shapes[shape][0] >= edge_free_since:
+                        candidate = shapes[shape][0], shapes[shape][1] - offset
+                    shapes[shape] = generation, offset
+                seen[key] = generation
 
-        for _ in range(self.height - 1):
-            self.data.append(self._next_row(self.data[-1]))
+            if candidate is not None:
+                # The next rows are simulated as usual and kept. If they lead back to this row (moved like before)
+                # they are the cycle, and the hashes did not just collide.
+                start, cells = candidate
+                cycle = []
+                edge_free = True
+                for _ in range(generation - start):
+                    if generation == self.height:
+                        return
+                    yield row
+                    cycle.append(row)
+                    edge_free = edge_free and self._edge_free(row)
+                    row = self._step(row)
+                    generation += 1
 
-        # We'll scale the data so that 1 -> 255 and 0 -> 0
-        for i in range(len(self.data)):
-            for j in range(len(self.data[i])):
-                self.data[i][j] *= 255
+                if row == (self._moved(cycle[0], cells) if cells else cycle[0]) and (edge_free or not cells):
+                    self.transient, self.period, self.shift = start, len(cycle), cells
+                    yield from self._repeat(cycle, generation)
+                    return
+                edge_free_since = generation
+                continue
+
+            if not self._edge_free(row):
+                edge_free_since = generation + 1
+
+            yield row
+            row = self._step(row)
+            generation += 1
+
+    def _repeat(self, cycle: list, generation: int):
+        # The rows from generation on, copied from the cycle (moved along for shifted ones)
+        laps = 0
+        while generation < self.height:
+            laps += 1
+            for row in cycle:
+                if generation == self.height:
+                    return
+
+                row = self._moved(row, laps * self.shift) if self.shift else row
+                if row is None:
+                    # About to run into an edge: simulate on from the last row copied
+                    yield from self._simulate(previous, generation)
+                    return
+
+                yield row
+                previous = row
+                generation += 1
+
+    def _simulate(self, row: int, generation: int):
+        # The rows after row (which is at generation - 1), simulated
+        while generation < self.height:
+            row = self._step(row)
+            yield row
+            generation += 1
+
+    def generate(self):
+        # Generate the Cellular Automata
+        # The rows are computed packed and only turned into lists of 0 / 255 here
+        self.data = [self._unpack(row) for row in self.packed_rows()]
 
         return self.data
     
     def save(self, filename: str):
         # Save the Cellular Automata as a PNG
-        png.Grayscale(filename, self.data).make()
+        # The data only holds 0 and 255, so auto() writes it as a 1 bit image
+        png.auto(filename, self.data).make()
+
+    def write(self, filename: str, compression: bool = True):
+        # Generate straight into a 1 bit PNG, a row at a time, without generate() or save()
+        # The packed rows are already PNG rows, so memory stays at one row and huge automata (100k x 100k) are fine
+        with png.Stream(filename, self.width, self.height, depth=1, compression=compression) as output:
+            for row in self.packed_rows():
+                output.write_packed(row.to_bytes(self.row_bytes, 'big'))
 
 
 def test():
@@ -90,17 +264,268 @@ def test():
     ca.save(f'{DIR}{rule}_{ca.seed_type.name}.png')
 
 
+def test_packed():
+    # The packed rows should match the cell by cell rule for every rule, seeds on both edges included
+    for rule in range(256):
+        for width in (1, 2, 7, 8, 9, 67):
+            for seed_type in SEED_TYPE:
+                ca = CA(rule, width, 24, seed_type)
+                row = [int(bit) for bit in format(random.getrandbits(width), f'0{width}b')] if seed_type == SEED_TYPE.RANDOM else ca._init_seed()
+                packed = ca._pack(row)
+
+                for _ in range(ca.height):
+                    assert ca._unpack(packed) == [255 * cell for cell in row], f'rule {rule} width {width} {seed_type.name}'
+                    packed = ca._step(packed)
+                    if width > 1:
+                        row = ca._next_row(row)
+                    else:
+                        row = [ca._rule(0, row[0], 0)]
+    print('Packed rows match for all 256 rules')
+
+
+def test_cycles():
+    # Copying cycles should give the same rows as simulating every one, shifted cycles running into the edges included
+    cycled = 0
+    for rule in range(256):
+        for width in (1, 8, 31, 100):
+            for seed_type in SEED_TYPE:
+                for detect_shifts in (False, True):
+                    state = random.getstate()
+                    ca = CA(rule, width, 300, seed_type, detect_shifts=detect_shifts)
+                    # A small table as well, which is emptied during the run
+                    ca.max_seen = 300 if rule % 2 else 7
+                    rows = list(ca.packed_rows())
+                    random.setstate(state)
+                    expected = list(CA(rule, width, 300, seed_type, detect_cycles=False).packed_rows())
+                    assert rows == expected, f'rule {rule} width {width} {seed_type.name} shifts {detect_shifts}'
+                    cycled += ca.period is not None
+    print(f'Cycles copied correctly, {cycled} of {256 * 4 * 4 * 2} runs cycled')
+
+
+def seed_batch(width: int, seed_types: tuple = tuple(SEED_TYPE), count: int = 1) -> np.ndarray:
+    '''count seeds of each seed type, one per row, as a uint8 array of 0 / 1 (only the random ones differ).
+    Any other seeds x width array of 0 / 1 works with sweep() too, e.g. many random seeds per rule:
+    np.random.default_rng().integers(0, 2, (1000, width))'''
+    return np.array([CA(0, width, 1, seed_type)._init_seed() for seed_type in seed_types for _ in range(count)], dtype=np.uint8)
+
+
+def rule_table(rule: int, states: int = 2, radius: int = 1, totalistic: bool = False) -> np.ndarray:
+    '''The next state of every neighbourhood of 2 * radius + 1 cells, indexed by the neighbourhood read as a base states number
+    (leftmost cell first), as a uint8 array. rule is Wolfram's code: its base states digits, lowest first, are the next states
+    of neighbourhoods 0, 1, 2, ... or, if totalistic, of the neighbourhood sums 0, 1, 2, ...
+    (k = 3, r = 1 has 3^27 rules, 3^7 of them totalistic.)'''
+
+    if not 2 <= states <= 256:
+        raise ValueError('States must be from 2-256')
+
+    neighbourhoods = states ** (2 * radius + 1)
+    digits = (states - 1) * (2 * radius + 1) + 1 if totalistic else neighbourhoods
+    if not 0 <= rule < states ** digits:
+        raise ValueError(f'Rule must be an integer from 0-{states ** digits - 1}')
+
+    table = np.empty(digits, dtype=np.uint8)
+    for i in range(digits):
+        rule, table[i] = divmod(rule, states)
+
+    if totalistic:
+        # The sum of each neighbourhood's digits picks its entry
+        index = np.arange(neighbourhoods)
+        sums = np.zeros(neighbourhoods, dtype=np.intp)
+        for _ in range(2 * radius + 1):
+            index, digit = np.divmod(index, states)
+            sums += digit
+        table = table[sums]
+
+    return table
+
+
+def sweep(rules, seeds: np.ndarray, height: int, states: int = 2, radius: int = 1, totalistic: bool = False):
+    '''Runs every rule from every seed in lockstep, with the same zero edges as CA.
+    Yields height generations, each a uint8 array of states shaped rules x seeds x width. The array is reused, copy it to keep it.
+    The elementary rules (0-255) are the default, see rule_table for the others.'''
+
+    seeds = np.asarray(seeds, dtype=np.uint8)
+    if states != 2 or radius != 1 or totalistic:
+        yield from _sweep_tables(np.array([rule_table(rule, states, radius, totalistic) for rule in rules]), seeds, height, states, radius)
+        return
+
+    rules = np.asarray(rules, dtype=np.intp)
+    if rules.min(initial=0) < 0 or rules.max(initial=0) > 255:
+        raise ValueError('Rule must be an integer from 0-255')
+
+    # A rule is its own lookup table: bit n is the next state of neighbourhood n = 4 * left + 2 * center + right.
+    # Shifting the rule right by the neighbourhood looks every cell up at once, all in uint8.
+    table = rules.astype(np.uint8)[:, None, None]
+
+    cells = np.broadcast_to(seeds, (len(rules),) + seeds.shape).copy()
+    index = np.empty(cells.shape, dtype=np.uint8)
+
+    for step in range(height):
+        yield cells
+        if step == height - 1:
+            break
+
+        np.left_shift(cells, 1, out=index)
+        index[..., 1:] |= cells[..., :-1] << 2
+        index[..., :-1] |= cells[..., 1:]
+        np.right_shift(table, index, out=index)
+        np.bitwise_and(index, 1, out=cells)
+
+
+def _sweep_tables(tables: np.ndarray, seeds: np.ndarray, height: int, states: int, radius: int):
+    # sweep() for any number of states and radius, one rule_table per rule
+    count, size = tables.shape
+    table = tables.ravel()
+    width = seeds.shape[-1]
+
+    # The neighbourhood of every cell as a base states number, built a digit at a time from windows of the padded row
+    # (one pass per cell of the neighbourhood), plus where its rule's table starts
+    dtype = np.min_scalar_type(table.size - 1)
+    offsets = (size * np.arange(count, dtype=dtype))[:, None, None]
+
+    cells = np.broadcast_to(seeds, (count,) + seeds.shape).copy()
+    padded = np.zeros(cells.shape[:-1] + (width + 2 * radius,), dtype=dtype)
+    index = np.empty(cells.shape, dtype=dtype)
+
+    for step in range(height):
+        yield cells
+        if step == height - 1:
+            break
+
+        padded[..., radius:radius + width] = cells
+        index[...] = padded[..., :width]
+        for i in range(1, 2 * radius + 1):
+            index *= states
+            index += padded[..., i:i + width]
+        index += offsets
+        np.take(table, index, out=cells)
+
+
+def atlas(filename: str, rules, seeds: np.ndarray, height: int, gap: int = 0, compression: bool = True,
+          states: int = 2, radius: int = 1, totalistic: bool = False, palette: list = None):
+    '''Writes one PNG per rule, filename.format(rule=rule), holding its run from each seed side by side with gap columns of state 0 between.
+    The rules are simulated together by sweep() in chunks of MAX_OPEN, with each chunk's files open at once and written a row at a time.
+    If a chunk fails its unfinished files are removed, the ones from earlier chunks are complete and stay.
+    Elementary rules give 1 bit grayscale images, other rules indexed-color ones with palette (grays from black to white by default).'''
+
+    rules = list(rules)
+    seeds = np.asarray(seeds, dtype=np.uint8)
+    count, width = seeds.shape
+    image_width = count * (width + gap) - gap
+    elementary = states == 2 and radius == 1 and not totalistic
+
+    depth = next(d for d in (1, 2, 4, 8) if states <= 2 ** d)
+    if elementary:
+        options = dict(depth=1)
+    else:
+        palette = palette or [(255 * i // (states - 1),) * 3 for i in range(states)]
+        options = dict(depth=depth, color_type=png.Color.PALETTE, palette=palette)
+
+    # Rows are packed here, 8 // depth pixels a byte with the first in the highest bits, padded to whole bytes
+    per_byte = 8 // depth
+    shifts = (depth * np.arange(per_byte - 1, -1, -1)).astype(np.uint8)
+    row_bytes = (image_width * depth + 7) // 8
+
+    for first in range(0, len(rules), MAX_OPEN):
+        chunk = rules[first:first + MAX_OPEN]
+
+        # Each generation is laid out with its gaps here, then packed into PNG rows
+        rows = np.zeros((len(chunk), -(-(count * (width + gap)) // per_byte) * per_byte), dtype=np.uint8)
+        layout = rows[:, :count * (width + gap)].reshape(len(chunk), count, width + gap)
+        outputs = [png.Stream(filename.format(rule=rule), image_width, height, compression=compression, **options) for rule in chunk]
+
+        try:
+            for output in outputs:
+                output.open()
+
+            for cells in sweep(chunk, seeds, height, states, radius, totalistic):
+                layout[..., :width] = cells
+                packed = np.bitwise_or.reduce(rows.reshape(len(chunk), -1, per_byte) << shifts, axis=-1)
+                for output, row in zip(outputs, packed):
+                    output.write_packed(row[:row_bytes].tobytes())
+
+            for output in outputs:
+                # close() closes the file, after which it is complete and no longer removed
+                output.close()
+                output.file = None
+        except BaseException:
+            for output in outputs:
+                if output.file is not None:
+                    output.file.close()
+                    output.file = None
+                    os.remove(output.filename)
+            raise
+
+
+def deep(rule: int, width: int, generations, filename: str, seed_type: SEED_TYPE = SEED_TYPE.CENTER, compression: bool = True):
+    '''Writes a 1 bit PNG with one row per generation in generations (e.g. range(0, 10**6, 1000)), using macrocell.MacroCA.
+    The seed is the usual one across width cells, but the row has no edges: it goes on empty past both sides, so
+    rows differ from CA once the pattern reaches an edge. Needs an even rule (empty space stays empty).'''
+
+    generations = sorted(generations)
+    engine = macrocell.MacroCA(rule)
+    engine.seed(CA(rule, width, 1, seed_type)._init_seed())
+
+    row_bytes = (width + 7) // 8
+    with png.Stream(filename, width, len(generations), depth=1, compression=compression) as output:
+        for _, cells in engine.rows(generations, 0, width):
+            output.write_packed((cells << (8 * row_bytes - width)).to_bytes(row_bytes, 'big'))
+
+
+def test_sweep():
+    # Every rule run together should match each CA run alone
+    width, height = 67, 40
+    seeds = np.vstack([seed_batch(width), np.random.default_rng(1).integers(0, 2, (3, width))])
+
+    runs = np.array([cells.copy() for cells in sweep(range(256), seeds, height)])
+    for rule in range(256):
+        for s, seed in enumerate(seeds):
+            ca = CA(rule, width, height)
+            packed = ca._pack(seed.tolist())
+            for step in range(height):
+                assert ca._unpack(packed) == (255 * runs[step, rule, s]).tolist(), f'rule {rule} seed {s} step {step}'
+                packed = ca._step(packed)
+    print('sweep matches CA for all 256 rules')
+
+
+def test_rule_tables():
+    # The table path should match the elementary one, and a radius 2 rule the cell by cell definition
+    width, height = 67, 30
+    seeds = np.vstack([seed_batch(width), np.random.default_rng(2).integers(0, 2, (2, width))]).astype(np.uint8)
+    fast = np.array([cells.copy() for cells in sweep(range(256), seeds, height)])
+    tables = np.array([rule_table(rule) for rule in range(256)])
+    general = np.array([cells.copy() for cells in _sweep_tables(tables, seeds, height, 2, 1)])
+    assert (fast == general).all(), 'elementary rules differ through the tables'
+
+    rng = random.Random(3)
+    for states, radius, totalistic in ((3, 1, False), (3, 1, True), (4, 2, True), (2, 3, False)):
+        rule = rng.randrange(states ** ((states - 1) * (2 * radius + 1) + 1 if totalistic else states ** (2 * radius + 1)))
+        seed = np.random.default_rng(4).integers(0, states, (1, width)).astype(np.uint8)
+        run = [cells[0, 0].tolist() for cells in sweep([rule], seed, height, states, radius, totalistic)]
+
+        row = seed[0].tolist()
+        code = [(rule // states ** i) % states for i in range(states ** (2 * radius + 1))]
+        for step in range(height):
+            assert run[step] == row, f'{states} states radius {radius} totalistic {totalistic} step {step}'
+            padded = [0] * radius + row + [0] * radius
+            window = [padded[x:x + 2 * radius + 1] for x in range(width)]
+            if totalistic:
+                row = [code[sum(cells)] for cells in window]
+            else:
+                row = [code[reduce(lambda index, cell: index * states + cell, cells)] for cells in window]
+    print('rule tables match')
+
+
 def main():
 
     width = 511
     height = 511
 
-    for rule in range(256):
-        for seed_type in SEED_TYPE:
-            ca = CA(rule, width, height, seed_type)
-            ca.generate()
-            ca.save(f'{DIR}{rule}_{seed_type.name}.png')
+    # Every rule from every seed type in one pass, one image per rule ({rule}.png) with the seed types side by side
+    # (RANDOM, CENTER, LEFT, RIGHT, 16 columns apart). sweep() runs all the rules at once in a single process, which is
+    # faster than the png.batch workers the separate {rule}_{seed type}.png images used to be rendered with.
+    atlas(DIR + '{rule}.png', range(256), seed_batch(width), height, gap=16)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,6 +1,12 @@
 import math
 import time
+from functools import partial
+import numpy as np
+import blur
+import expression
 import pngenerator as png
+import quadtree
+import tilecache
 
 FILENAME = "plots/tanx.png"
 X_MIN = -7
@@ -12,9 +18,87 @@ RESOLUTION = 512
 NBHD = 0.1
 CENTER = 0
 
+# Rendered tiles are kept here, so exploring nearby views only renders what is new. None renders everything.
+CACHE_DIR = 'plots/.tilecache'
+
+# Render with render_adaptive() (and adaptive cache tiles), which only evaluates f near the curve: much faster for thin curves
+# of costly functions, but slower for ones like tan(x) - y that broadcast well, and it can miss features smaller than its coarse grid
+ADAPTIVE = False
+
+# Rows evaluated per block by render(), bounds the memory used for the coordinate and value arrays
+BLOCK_ROWS = 256
+
+# f as text (see expression.py), e.g. 'tan(x) - y', used instead of f below when set
+FORMULA = None
+
 def f(x, y):
     return math.tan(x) - y
 
+# math functions whose NumPy ufunc has a different name
+_NUMPY_NAMES = {
+    'asin': 'arcsin', 'acos': 'arccos', 'atan': 'arctan', 'atan2': 'arctan2',
+    'asinh': 'arcsinh', 'acosh': 'arccosh', 'atanh': 'arctanh', 'pow': 'power',
+}
+
+def vectorize(f):
+    '''Returns a version of f(x, y) that takes NumPy arrays.
+    f is used as it is if it already works on arrays. Otherwise, if it is written with the math module,
+    it is rebuilt with math swapped for the matching NumPy ufuncs. As a last resort np.vectorize calls f per element.
+    f can also be a formula, which is compiled.'''
+
+    if isinstance(f, str):
+        return expression.compile_kernel(f, ('x', 'y'))
+
+    x = np.array([-1.5, -0.25, 0.5, 2.0])
+    y = np.array([0.75, -2.0, 1.25, -0.5])
+    expected = np.array([f(a, b) for a, b in zip(x.tolist(), y.tolist())], dtype=float)
+
+    def works(g) -> bool:
+        try:
+            with np.errstate(all='ignore'):
+                values = np.broadcast_to(g(x, y), x.shape).astype(float)
+        except (TypeError, ValueError):
+            return False
+        return np.allclose(values, expected, equal_nan=True)
+
+    if works(f):
+        return f
+
+    numpy_math = type(math)('numpy_math')
+    for name in dir(math):
+        if name.startswith('_'):
+            continue
+        setattr(numpy_math, name, getattr(np, _NUMPY_NAMES.get(name, name), getattr(math, name)))
+
+    if 'math' in f.__code__.co_names:
+        g = type(f)(f.__code__, {**f.__globals__, 'math': numpy_math}, f.__name__, f.__defaults__, f.__closure__)
+        if works(g):
+            return g
+
+    return np.vectorize(f, otypes=[float])
+
+def render(f, width: int, height: int, low: float, high: float) -> np.ndarray:
+    '''Evaluates f over the plot area, BLOCK_ROWS rows at a time, and thresholds it like threshold_plot():
+    pixels with low <= f(x, y) <= high (or NaN) are 255, the rest 0. Returns a uint8 array ready for png.Grayscale.'''
+
+    f = vectorize(f)
+
+    # Same coordinates as the per pixel loop
+    w = np.arange(width)
+    h = np.arange(height)
+    x = X_MAX * w / width + X_MIN * (width - w) / width
+    y = Y_MAX * h / height + Y_MIN * (height - h) / height
+
+    plot = np.empty((height, width), dtype=np.uint8)
+    for top in range(0, height, BLOCK_ROWS):
+        rows = y[top:top + BLOCK_ROWS, None]
+        with np.errstate(all='ignore'):
+            values = np.broadcast_to(f(x[None, :], rows), (len(rows), width))
+            outside = (values < low) | (values > high)
+        plot[top:top + len(rows)] = np.where(outside, 0, 255)
+
+    return plot
+
 def threshold_plot(plot, min, max):
     for row in plot:
         for i in range(len(row)):
@@ -96,35 +180,81 @@ def add_gridlines(plot):
 
     return plot
 
+def render_adaptive(f, width: int, height: int, low: float, high: float, stats: dict = None) -> np.ndarray:
+    '''Like render(), but only evaluates f near the curve, see quadtree.rasterize.
+    Much faster for thin bands, at the risk of missing features smaller than the coarse grid.'''
+
+    f = vectorize(f)
+
+    def f_pixels(px, py):
+        x = X_MAX * px / width + X_MIN * (width - px) / width
+        y = Y_MAX * py / height + Y_MIN * (height - py) / height
+        return f(x, y)
+
+    mask = quadtree.rasterize(f_pixels, width, height, low, high, stats=stats)
+    return np.where(mask, 255, 0).astype(np.uint8)
+
+def band_tile(f, low: float, high: float, x: np.ndarray, y: np.ndarray, adaptive: bool = False) -> np.ndarray:
+    # One cache tile of the band low <= f <= high, x and y are the tile's pixel coordinates
+    f = vectorize(f)
+    if adaptive:
+        mask = quadtree.rasterize(lambda px, py: f(x[px.astype(int)], y[py.astype(int)]), len(x), len(y), low, high)
+    else:
+        with np.errstate(all='ignore'):
+            values = np.broadcast_to(f(x[None, :], y[:, None]), (len(y), len(x)))
+            mask = ~((values < low) | (values > high))
+    return np.where(mask, 255, 0).astype(np.uint8)
+
+def test_blur():
+    # The blur module should match the per pixel blurs above
+    # The Gaussian sums in a different order, so truncation can land one level apart
+    plot = render(lambda x, y: x * x + y * y - 16, 96, 80, -4, 4)
+    plot[20:30, 10:70] = 255
+
+    for sigma in (1, 2, 3):
+        expected = np.array(gaussian_blur(plot.tolist(), sigma))
+        for fft in (False, True):
+            difference = np.abs(blur.gaussian_blur(plot, sigma, fft=fft).astype(int) - expected)
+            assert difference.max() <= 1, f'gaussian_blur sigma {sigma} fft {fft} is off by {difference.max()}'
+            print(f'gaussian_blur sigma {sigma} fft {fft}: {np.count_nonzero(difference)} pixels off by 1')
+
+    for radius in (1, 2, 5, 40):
+        expected = np.array(average_blur(plot.tolist(), radius))
+        assert (blur.box_blur(plot, radius) == expected).all(), f'box_blur radius {radius} differs'
+        print(f'box_blur radius {radius}: identical')
+
+def test_adaptive():
+    # The adaptive renderer should match the full one on curves with no features smaller than its coarse grid
+    width, height = 14 * 64, 14 * 48
+    curves = [f, lambda x, y: x * x + y * y - 9, lambda x, y: math.sin(3 * x) - y, lambda x, y: x * y - 1]
+
+    for curve in curves:
+        stats = {}
+        expected = render(curve, width, height, CENTER - NBHD, CENTER + NBHD)
+        plot = render_adaptive(curve, width, height, CENTER - NBHD, CENTER + NBHD, stats)
+        assert (plot == expected).all(), f'{np.count_nonzero(plot != expected)} pixels differ'
+        print(f"identical, {stats['evaluations']} evaluations for {width * height} pixels")
+
 def main():
 
     png_height = (Y_MAX - Y_MIN) * RESOLUTION
     png_width = (X_MAX - X_MIN) * RESOLUTION
+    function = f if FORMULA is None else FORMULA
 
     # Each pixel will be greyscale 8-bit
-    # The plot will be a list of lists of integers
-    """
-    [[11, 12, 13, ...],
-     [21, 22, 23, ...],
-     [31, 32, 33, ...],
-     ...
-    """
-    plot = []
-
-    for h in range(png_height):
-        row = []
-        for w in range(png_width):
-            # Get the x and y coordinates
-            x = X_MAX * w / png_width + X_MIN * (png_width - w) / png_width
-            y = Y_MAX * h / png_height + Y_MIN * (png_height - h) / png_height
-
-            row.append(f(x, y))
-        plot.append(row)
-
-    plot = threshold_plot(plot, CENTER - NBHD, CENTER + NBHD)
+    # The plot is a uint8 array, f is evaluated a block of rows at a time
+    start_time = time.time()
+    if CACHE_DIR is None:
+        plot = (render_adaptive if ADAPTIVE else render)(function, png_width, png_height, CENTER - NBHD, CENTER + NBHD)
+    else:
+        cache = tilecache.TileCache(CACHE_DIR)
+        key = tilecache.source_key(function, CENTER - NBHD, CENTER + NBHD, ADAPTIVE)
+        plot = cache.render(partial(band_tile, function, CENTER - NBHD, CENTER + NBHD, adaptive=ADAPTIVE), key, X_MIN, Y_MIN, png_width, png_height, RESOLUTION)
+        print(f"{cache.hits} tiles from the cache, {cache.misses} rendered")
+    print("Rendered in ", time.time() - start_time, " seconds")
     
-    # plot = average_blur(plot, 1)
-    # plot = gaussian_blur(plot, 1)
+    # plot = blur.box_blur(plot, 1)
+    # plot = blur.gaussian_blur(plot, 1)
 
     # plot = add_gridlines(plot)
 
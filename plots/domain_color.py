@@ -1,9 +1,19 @@
 import cmath
+import json
 import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import expression
 import pngenerator as png
+import tilecache
 
 FILENAME = 'plots/complexlog.png'
 
+# Rendered tiles are kept here, so exploring nearby views only renders what is new. None renders everything.
+CACHE_DIR = 'plots/.tilecache'
+
 X_MIN = -2
 X_MAX = 2
 Y_MIN = -2
@@ -12,20 +22,34 @@ RESOLUTION = 1024
 
 BIT_DEPTH = 16
 
+# Rows rendered together by rows(), bounds the memory used
+BLOCK_ROWS = 64
+
+# For plots too big for one process: bands of BAND_ROWS rows are rendered by WORKERS processes (None for one per core)
+# into a memory-mapped file next to FILENAME, which is then streamed into the PNG. An interrupted run carries on
+# from the bands it finished. Takes precedence over CACHE_DIR.
+TILED = False
+BAND_ROWS = 256
+WORKERS = None
+
 # We'll color the plot as follows
 # phase         -> hue
 # magnitude     -> lightness
 
-def f(z: complex) -> complex:
+# Poles are marked with this, it comes out white
+POLE = complex(math.inf, math.inf)
+
+# f as text (see expression.py), e.g. 'log(z)' or 'z / (z^2 - 1)', used instead of f below when set
+FORMULA = None
+
+def f(z):
     '''
-    if (z ** 2 - 1) == 0:
-        return complex(math.inf, math.inf)
-    return z / (z**2 - 1)
+    z is a complex number or a NumPy array of them, use np functions (np.log, np.sinh, ...) so both work
+    return np.where(z ** 2 - 1 == 0, POLE, z / (z**2 - 1))
     '''
-    # return cmath.sinh(cmath.exp(z)) - 1
-    if abs(z) == 0:
-        return complex(math.inf, math.inf)
-    return cmath.log(z)
+    # return np.sinh(np.exp(z)) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(z == 0, POLE, np.log(z))
 
 
 def color(z: complex) -> tuple:
@@ -74,27 +98,142 @@ def color(z: complex) -> tuple:
     c_tuple = (c[0], c[1], c[2])
     return c_tuple
 
+# color() for arrays. The hue of each channel, (1 + cos(phase + offset)) / 2, is looked up in a table of
+# HUE_LUT_SIZE phases over [-pi, pi]. The nearest entry is within pi / (2 * (HUE_LUT_SIZE - 1)) = 2.4e-5 of the cosines, or 1.6
+# levels at 16 bit, so after truncating to integers colors() is within 2 levels of color() where |w| <= 1. Brighter pixels
+# scale the error by their lightness (|w|^(1/8)) until they clip to white.
+HUE_LUT_SIZE = 2 ** 16
+HUE_LUT = (1 + np.cos(np.linspace(-math.pi, math.pi, HUE_LUT_SIZE)[:, None] + np.array([0, 2 * math.pi / 3, -2 * math.pi / 3]))) / 2
+
+def colors(w: np.ndarray) -> np.ndarray:
+    '''Colors an array of values like color() does, returns a uint16 array with an (r, g, b) axis added.
+    Infinite values (poles) come out white and NaN black, with no per pixel branches.'''
+
+    top = 2 ** BIT_DEPTH - 1
+
+    # NaN -> magnitude 0 and phase 0, so black
+    magnitude = np.nan_to_num(np.abs(w), nan=0.0, posinf=math.inf)
+    phase = np.nan_to_num(np.angle(w))
+
+    index = np.rint((phase + math.pi) * ((HUE_LUT_SIZE - 1) / (2 * math.pi))).astype(np.intp)
+    lightness = np.sqrt(np.sqrt(np.sqrt(magnitude)))
+
+    # A pole times a zero hue is NaN, fmin picks the 1 over it like it does for inf
+    with np.errstate(invalid='ignore'):
+        c = np.fmin(HUE_LUT[index] * lightness[..., None], 1.0)
+    return (c * top).astype(np.uint16)
+
+def function():
+    # f, or FORMULA compiled (once, the kernels are cached)
+    return f if FORMULA is None else expression.compile_kernel(FORMULA, ('z',))
+
+def render(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    # The colors of the grid of x (columns) and y (rows), also used for the cache tiles
+    with np.errstate(all='ignore'):
+        w = function()(x[None, :] + 1j * y[:, None])
+    return colors(w)
+
+def rows(png_width: int, png_height: int):
+    # Rows are generated a block at a time so the whole plot never sits in memory
+    x = X_MIN + np.arange(png_width) / RESOLUTION
+    for top in range(0, png_height, BLOCK_ROWS):
+        y = Y_MAX - np.arange(top, min(top + BLOCK_ROWS, png_height)) / RESOLUTION
+        yield from render(x, y)
+
+def _render_band(path: str, shape: tuple, x_min: float, y_max: float, resolution: float, top: int, bottom: int) -> int:
+    # Runs in a worker process, renders rows top to bottom straight into the memory-mapped image
+    image = np.memmap(path, dtype=np.uint16, mode='r+', shape=shape)
+    x = x_min + np.arange(shape[1]) / resolution
+    y = y_max - np.arange(top, bottom) / resolution
+    image[top:bottom] = render(x, y)
+    image.flush()
+    return top
+
+def render_tiled(png_width: int, png_height: int, band_rows: int = BAND_ROWS, workers: int = None) -> np.memmap:
+    '''Renders the plot in bands across worker processes into FILENAME + '.bands', a uint16 memory-mapped array.
+    Finished bands are listed in FILENAME + '.done', so running again after an interruption only renders the rest.
+    Returns the image, read only. Delete both files once they are no longer needed.'''
+
+    path = FILENAME + '.bands'
+    progress_path = FILENAME + '.done'
+    shape = (png_height, png_width, 3)
+    key = tilecache.source_key(f if FORMULA is None else FORMULA, colors, BIT_DEPTH, HUE_LUT_SIZE, X_MIN, Y_MAX, RESOLUTION, shape, band_rows)
+
+    done = set()
+    if os.path.exists(path) and os.path.exists(progress_path):
+        with open(progress_path) as file:
+            progress = json.load(file)
+        if progress['key'] == key:
+            done = set(progress['done'])
+
+    if not done:
+        # A new (sparse) file, nothing in it can be trusted
+        np.memmap(path, dtype=np.uint16, mode='w+', shape=shape).flush()
+
+    bands = range(0, png_height, band_rows)
+    if done:
+        print(f"Resuming, {len(done)} of {len(bands)} bands already rendered")
+
+    executor = ProcessPoolExecutor(workers)
+    try:
+        start_time = time.time()
+        futures = [executor.submit(_render_band, path, shape, X_MIN, Y_MAX, RESOLUTION, top, min(top + band_rows, png_height))
+                   for top in bands if top not in done]
+
+        for future in as_completed(futures):
+            top = future.result()
+            done.add(top)
+
+            # Written beside and moved into place, so an interruption never leaves a half written list
+            with open(progress_path + '.tmp', 'w') as file:
+                json.dump({'key': key, 'done': sorted(done)}, file)
+            os.replace(progress_path + '.tmp', progress_path)
+
+            print(f"Band {len(done)}/{len(bands)} (rows {top}-{min(top + band_rows, png_height) - 1}) done, {time.time() - start_time:.1f} seconds")
+    finally:
+        # Cancel what has not started yet (e.g. on Ctrl+C), the finished bands are already recorded
+        executor.shutdown(wait=True, cancel_futures=True)
+
+    return np.memmap(path, dtype=np.uint16, mode='r', shape=shape)
+
+def test_colors():
+    # colors() should match color() to within the hue table's precision, poles and zeros included
+    x = np.linspace(-3, 3, 301)
+    y = np.linspace(-2, 2, 201)
+    w = f(x[None, :] + 1j * y[:, None])
+    w[0, :4] = [POLE, 0, complex(-1e300, 0.0), complex(1e-300, -1e-300)]
+
+    expected = np.array([[color(complex(value)) for value in row] for row in w.tolist()])
+    difference = np.abs(colors(w).astype(int) - expected)
+    assert difference.max() <= 2, f'colors() is off by {difference.max()}'
+    print(f'colors() within {difference.max()} levels of color()')
+
 def main():
     
     png_height = (Y_MAX - Y_MIN) * RESOLUTION
     png_width = (X_MAX - X_MIN) * RESOLUTION
 
-    plot = []
-
     print("Generating plot...")
-    for im in range(png_height):
-        row = []
-        for re in range(png_width):
-            x = X_MIN + re / RESOLUTION
-            y = Y_MAX - im / RESOLUTION
-            z = complex(x, y)
-            row.append(color(f(z)))
-        plot.append(row)
+    if TILED:
+        plot = render_tiled(png_width, png_height, BAND_ROWS, WORKERS)
+    elif CACHE_DIR is None:
+        plot = rows(png_width, png_height)
+    else:
+        cache = tilecache.TileCache(CACHE_DIR)
+        key = tilecache.source_key(f if FORMULA is None else FORMULA, colors, BIT_DEPTH, HUE_LUT_SIZE)
+        plot = cache.rows(render, key, X_MIN, Y_MAX, png_width, png_height, RESOLUTION, y_sign=-1)
+
+    output = png.Stream(FILENAME, png_width, png_height, plot, depth=BIT_DEPTH, color_type=png.Color.RGB, compression=True)
+    output.make()
 
+    if TILED:
+        # The PNG is done, the bands are not needed any more
+        del plot
+        os.remove(FILENAME + '.bands')
+        os.remove(FILENAME + '.done')
+    elif CACHE_DIR is not None:
+        print(f"{cache.hits} tiles from the cache, {cache.misses} rendered")
     print("Plot generated")
 
-    output = png.RGB(FILENAME, plot, depth=BIT_DEPTH, compression=True)
-    output.make()
-
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -5,15 +5,32 @@
 
 # PNG Encoder using only the Python Standard Library
 # Designed to be simple and easy to use
+# Progress messages and stage timings go through profiling.py, quiet unless asked for
 
 # Author: Rick Howell
 # rick.howell.arts@gmail.com
 
+import array
+import contextlib
+import io
 import math
+import sys
 import time
 import zlib
 from abc import abstractmethod, ABC
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from enum import Enum
+from fractions import Fraction
+from itertools import chain
+
+import profiling
+
+try:
+    import numpy as np
+except ImportError:
+    # NumPy is optional, it is only used for row filtering and speeds up auto() and frame differencing
+    np = None
 
 def angle2rgb(angle: float, bit_depth: int = 255) -> tuple:
     """Angle should be in radians from -pi to pi. \n
@@ -35,16 +52,296 @@ def angle2rgb(angle: float, bit_depth: int = 255) -> tuple:
 class Color(Enum):
     GRAYSCALE = 0
     RGB = 2
+    PALETTE = 3
+
+# Bit depths allowed by the PNG spec for each color type
+_DEPTHS = {
+    Color.GRAYSCALE: [1, 2, 4, 8, 16],
+    Color.RGB: [8, 16],
+    Color.PALETTE: [1, 2, 4, 8]
+}
+
+class Filter(Enum):
+    NONE = 0
+    SUB = 1
+    UP = 2
+    AVERAGE = 3
+    PAETH = 4
+    ADAPTIVE = 5
+
+def _check_format(view: memoryview, depth: int):
+    if view.format.lstrip('@=<>!') not in ('B', 'H') or view.itemsize != (2 if depth == 16 else 1):
+        raise ValueError(f'Invalid buffer format {view.format!r}. Must be uint16 for depth 16, otherwise uint8.')
+
+def _as_buffer(data, depth: int, channels: int):
+    '''Returns a memoryview of data if it supports the buffer protocol (e.g. a NumPy array), otherwise None. \n
+    The buffer must hold uint8 (depth 1 - 8) or uint16 (depth 16) samples shaped H x W or H x W x channels.'''
+
+    try:
+        view = memoryview(data)
+    except TypeError:
+        return None
+
+    if not (view.ndim == 3 and view.shape[2] == channels) and not (view.ndim == 2 and channels == 1):
+        raise ValueError(f'Invalid buffer shape {view.shape}. Must be H x W' + (' x 3.' if channels == 3 else ' or H x W x 1.'))
+
+    _check_format(view, depth)
+
+    return view
+
+def _big_endian(view: memoryview) -> bytes:
+    '''Returns the samples of a buffer as bytes, byteswapping 16 bit samples to big endian in bulk'''
+
+    raw = view.tobytes()
+
+    if view.itemsize == 2:
+        order = view.format[0]
+        little = order == '<' or (order not in '>!' and sys.byteorder == 'little')
+        if little:
+            samples = array.array('H', raw)
+            samples.byteswap()
+            raw = samples.tobytes()
+
+    return raw
+
+def _pack_rows(rows: list, depth: int, channels: int) -> bytes:
+    '''Packs rows of pixel values (or (r, g, b) tuples) into unfiltered big endian bytes, one byte per sample below depth 16'''
+
+    if depth < 16:
+        if channels == 1:
+            return b''.join([bytes(row) for row in rows])
+        return b''.join([bytes(chain.from_iterable(row)) for row in rows])
+
+    if channels == 1:
+        return b''.join([b''.join([x.to_bytes(2, 'big') for x in row]) for row in rows])
+    return b''.join([b''.join([r.to_bytes(2, 'big') + g.to_bytes(2, 'big') + b.to_bytes(2, 'big') for r, g, b in row]) for row in rows])
+
+def _changed(previous: bytes, current: bytes, height: int, pixel_size: int):
+    '''Returns the (x, y, width, height) rectangle around the pixels that differ between two frames, or None if they are equal. \n
+    Without NumPy the frames are XORed as big integers, so the first and last differing bytes fall out of bit_length() without a loop over pixels.'''
+
+    if previous == current:
+        return None
+
+    stride = len(current) // height
+
+    if np is not None:
+        diff = np.frombuffer(previous, dtype=np.uint8).reshape(height, stride) != np.frombuffer(current, dtype=np.uint8).reshape(height, stride)
+        rows = np.flatnonzero(diff.any(axis=1))
+        columns = np.flatnonzero(diff.any(axis=0))
+        top, bottom = int(rows[0]), int(rows[-1])
+        left, right = int(columns[0]) // pixel_size, int(columns[-1]) // pixel_size
+        return left, top, right - left + 1, bottom - top + 1
+
+    def span(a: bytes, b: bytes) -> tuple:
+        diff = int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+        first = len(b) - (diff.bit_length() + 7) // 8
+        last = len(b) - 1 - ((diff & -diff).bit_length() - 1) // 8
+        return first, last
+
+    first, last = span(previous, current)
+    top, bottom = first // stride, last // stride
+
+    left, right = stride, 0
+    for y in range(top, bottom + 1):
+        row = slice(y * stride, (y + 1) * stride)
+        if previous[row] != current[row]:
+            first, last = span(previous[row], current[row])
+            left, right = min(left, first), max(right, last)
+
+    left, right = left // pixel_size, right // pixel_size
+    return left, top, right - left + 1, bottom - top + 1
+
+def _check_palette(palette: list, depth: int, color_type: Enum = Color.PALETTE):
+    # PLTE is required for indexed color, allowed as a suggestion for RGB, and forbidden for grayscale
+    if color_type == Color.GRAYSCALE:
+        raise ValueError('Invalid palette. Grayscale images cannot have one.')
+
+    most = 2**depth if color_type == Color.PALETTE else 256
+    if not 0 < len(palette) <= most:
+        raise ValueError(f'Invalid palette. Must have between 1 and {most} colors for {color_type.name} at depth {depth}.')
+
+def _check_indices(data: bytes, palette: list):
+    # data holds one index per byte, before any bit packing
+    if data and max(data) >= len(palette):
+        raise ValueError(f'Invalid palette index {max(data)}. The palette only has {len(palette)} colors.')
+
+def _pack_bits(raw: bytes, height: int, depth: int) -> bytes:
+    '''Packs one sample per byte into depth (1, 2 or 4) bit samples, padding every row to a whole byte. \n
+    The samples are turned into base 2^depth digits and parsed by int() in one go, so the packing runs in C.'''
+
+    width = len(raw) // height
+    per_byte = 8 // depth
+
+    # Checked up front: an invalid digit is not enough, since int(..., 16) takes a leading 0x
+    if raw and max(raw) >= 2**depth:
+        raise ValueError(f'Invalid pixel value. Must be less than {2**depth} for depth {depth}.')
+    digits = raw.translate(bytes.maketrans(bytes(range(2**depth)), b'0123456789abcdef'[:2**depth]))
+
+    pad = b'0' * (-width % per_byte)
+    if pad:
+        rows = memoryview(digits)
+        digits = pad.join([rows[i:i + width] for i in range(0, len(digits), width)]) + pad
+
+    return int(digits, 2**depth).to_bytes(len(digits) // per_byte, 'big')
+
+def _filter_block(block, prior, bpp: int, filter: Enum):
+    # block is a rows x stride array of unfiltered bytes, prior is the row above it
+    x = block.astype(np.int16)
+    up = np.empty_like(x)
+    up[0] = prior
+    up[1:] = x[:-1]
+    left = np.zeros_like(x)
+    left[:, bpp:] = x[:, :-bpp]
+    upleft = np.zeros_like(x)
+    upleft[:, bpp:] = up[:, :-bpp]
+
+    def paeth():
+        pa = np.abs(up - upleft)
+        pb = np.abs(left - upleft)
+        pc = np.abs(left + up - 2 * upleft)
+        return np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+
+    predictors = {
+        Filter.NONE: lambda: 0,
+        Filter.SUB: lambda: left,
+        Filter.UP: lambda: up,
+        Filter.AVERAGE: lambda: (left + up) >> 1,
+        Filter.PAETH: paeth
+    }
+
+    if filter != Filter.ADAPTIVE:
+        types = np.full(len(x), filter.value, dtype=np.uint8)
+        filtered = ((x - predictors[filter]()) & 0xff).astype(np.uint8)
+    else:
+        # Minimum sum of absolute differences: pick the filter whose output, read as signed bytes, sums smallest
+        candidates = np.stack([((x - predictors[f]()) & 0xff).astype(np.uint8) for f in list(Filter)[:5]])
+        costs = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+        types = costs.argmin(axis=0).astype(np.uint8)
+        filtered = candidates[types, np.arange(len(x))]
+
+    return np.concatenate([types[:, None], filtered], axis=1)
+
+def _scanlines(raw: bytes, height: int, bpp: int, filter: Enum = Filter.NONE, prior: bytes = b'') -> bytes:
+    '''Builds the scanlines of an image from its unfiltered bytes, putting the filter type byte in front of every row. \n
+    bpp is the number of bytes per pixel, prior is the row above the first one (if any).'''
+
+    stride = len(raw) // height
+
+    if filter == Filter.NONE:
+        rows = memoryview(raw)
+        return b'\x00' + b'\x00'.join([rows[i:i + stride] for i in range(0, len(raw), stride)])
+
+    if np is None:
+        raise ImportError('Row filtering needs NumPy. Install it with: pip install numpy')
+
+    image = np.frombuffer(raw, dtype=np.uint8).reshape(height, stride)
+    prior = np.frombuffer(prior, dtype=np.uint8) if prior else np.zeros(stride, dtype=np.uint8)
+
+    # Filter in blocks of rows to bound the memory used by the candidate filters
+    block_rows = max(1, 2**20 // stride)
+    out = []
+    for i in range(0, height, block_rows):
+        out.append(_filter_block(image[i:i + block_rows], prior, bpp, filter).tobytes())
+        prior = image[min(i + block_rows, height) - 1]
+    return b''.join(out)
+
+def _adler32_combine(adler1: int, adler2: int, len2: int) -> int:
+    '''Returns the Adler-32 of two concatenated blocks from the checksums of each block'''
+
+    base = 65521
+    a = ((adler1 & 0xffff) + (adler2 & 0xffff) - 1) % base
+    b = ((adler1 >> 16) + (adler2 >> 16) + len2 * ((adler1 & 0xffff) - 1)) % base
+    return (b << 16) | a
+
+def _deflate_slab(data: bytes, zdict: bytes, level: int, last: bool) -> tuple:
+    # Raw deflate (no zlib header), primed with the tail of the previous slab so the ratio barely suffers.
+    # zlib releases the GIL while compressing, so slabs run in parallel on threads.
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict = zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    out = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out, zlib.adler32(data), len(data)
+
+class _ParallelCompressor:
+    '''
+    Drop-in for zlib.compressobj that compresses in parallel, in the style of pigz. \n
+    Input is cut into slabs, each slab is deflated on a worker thread and ends on a sync flush,
+    so the slabs can be stitched together into one valid zlib stream. The Adler-32 of the
+    whole stream is combined from the checksums of the slabs.
+    '''
+
+    def __init__(self, level: int, workers: int, slab_size: int = 2**20):
+        self.level = level
+        self.workers = workers
+        self.slab_size = slab_size
+        self.executor = ThreadPoolExecutor(workers)
+        self.jobs = deque()
+        self.buffer = bytearray()
+        self.zdict = b''
+        self.adler = 1
+
+        if level == zlib.Z_DEFAULT_COMPRESSION:
+            level = 6
+        flevel = 0 if level < 2 else 1 if level < 6 else 2 if level == 6 else 3
+        flg = flevel << 6
+        flg += 31 - (0x78 * 256 + flg) % 31
+        self.header = bytes([0x78, flg])
+
+    def _submit(self, data: bytes, last: bool):
+        self.jobs.append(self.executor.submit(_deflate_slab, data, self.zdict, self.level, last))
+        self.zdict = data[-32768:]
+
+    def _collect(self, block: bool) -> bytes:
+        out = [self.header]
+        self.header = b''
+        while self.jobs and (block or self.jobs[0].done()):
+            data, adler, length = self.jobs.popleft().result()
+            self.adler = _adler32_combine(self.adler, adler, length)
+            out.append(data)
+        return b''.join(out)
+
+    def compress(self, data: bytes) -> bytes:
+        self.buffer += data
+        while len(self.buffer) >= self.slab_size:
+            self._submit(bytes(self.buffer[:self.slab_size]), last = False)
+            del self.buffer[:self.slab_size]
+
+        # Back-pressure: never hold more than a couple of slabs per worker
+        if len(self.jobs) > 2 * self.workers:
+            return self._collect(block = True)
+        return self._collect(block = False)
+
+    def flush(self) -> bytes:
+        self._submit(bytes(self.buffer), last = True)
+        self.buffer = bytearray()
+        out = self._collect(block = True)
+        self.executor.shutdown()
+        return out + self.adler.to_bytes(4, 'big')
+
+    def abort(self):
+        # Instead of flush() after an error: drops the queued slabs and stops the threads
+        self.executor.shutdown(cancel_futures = True)
+        self.jobs.clear()
+
+def _compressor(level: int, workers: int = 1):
+    '''Returns a zlib stream compressor, running on the given number of threads'''
+
+    if workers > 1:
+        return _ParallelCompressor(level, workers)
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS)
 
 class _pngEncoder(ABC):
 
-    def __init__(self, filename: str, data: list, depth: int = 8, color_type: Enum = Color.GRAYSCALE, compression: bool = False):
+    def __init__(self, filename: str, data: list, depth: int = 8, color_type: Enum = Color.GRAYSCALE, compression: bool = False, workers: int = 1, filter: Enum = Filter.NONE):
     
             # Data Validation
             # TODO: Add more data validation that doesn't increase time complexity too much
 
-            if depth not in [8, 16]:
-                raise ValueError('Invalid depth. Must be 8, or 16.')
+            if depth not in _DEPTHS[color_type]:
+                raise ValueError(f'Invalid depth. Must be one of {_DEPTHS[color_type]} for {color_type.name}.')
             
             if filename[-4:] != '.png':
                 raise ValueError('Filename must _end with .png')
@@ -55,8 +352,18 @@ class _pngEncoder(ABC):
             self.color_type_str = color_type.name
             self.filename = filename
             self.data = data
-            self.width = len(data[0])
-            self.height = len(data)
+            self.channels = 3 if color_type == Color.RGB else 1
+            self.buffer = _as_buffer(data, depth, self.channels)
+
+            if self.buffer is not None:
+                self.height, self.width = self.buffer.shape[:2]
+            elif data is not None:
+                self.width = len(data[0])
+                self.height = len(data)
+
+            self.workers = workers
+            self.filter = filter
+            self.bpp = max(1, self.channels * depth // 8)
 
             if compression:
                 self.compression = zlib.Z_BEST_COMPRESSION
@@ -64,7 +371,10 @@ class _pngEncoder(ABC):
                 self.compression = zlib.Z_NO_COMPRESSION
 
     def __del__(self):
-        self.file.close()
+        # No file if __init__ raised, or the image was never made
+        file = getattr(self, 'file', None)
+        if file is not None:
+            file.close()
 
     def __str__(self) -> str:
         return f'PNG Encoder: {self.filename}, {self.width} x {self.height}, {self.depth} bit, {self.color_type_str}'
@@ -73,10 +383,11 @@ class _pngEncoder(ABC):
         return zlib.crc32(data) & 0xffffffff
     
     def _write_chunk(self, chunk_type: str, data: bytes):
-        self.file.write(len(data).to_bytes(4, 'big'))
-        self.file.write(chunk_type.encode())
-        self.file.write(data)
-        self.file.write(self._crc32(chunk_type.encode() + data).to_bytes(4, 'big'))
+        with profiling.stage('chunk.write', len(data) + 12):
+            self.file.write(len(data).to_bytes(4, 'big'))
+            self.file.write(chunk_type.encode())
+            self.file.write(data)
+            self.file.write(self._crc32(chunk_type.encode() + data).to_bytes(4, 'big'))
 
     def _signature(self):
         self.file.write(b'\x89PNG\r\n\x1a\n')
@@ -84,7 +395,7 @@ class _pngEncoder(ABC):
     def _header(self):
         width = self.width.to_bytes(4, 'big')
         height = self.height.to_bytes(4, 'big')
-        bit_depth = b'\x08' if self.depth == 8 else b'\x10'
+        bit_depth = self.depth.to_bytes(1, 'big')
         color_type = self.color_type.to_bytes(1, 'big')
         compression = b'\x00'
         filter_method = b'\x00'
@@ -92,6 +403,28 @@ class _pngEncoder(ABC):
 
         self._write_chunk('IHDR', width + height + bit_depth + color_type + compression + filter_method + interlace)
 
+    def _compress(self, data: bytes) -> bytes:
+        with profiling.stage('imdata.deflate', len(data)):
+            if self.workers > 1:
+                compressor = _compressor(self.compression, self.workers)
+                return compressor.compress(data) + compressor.flush()
+            return zlib.compress(data, level = self.compression, wbits = zlib.MAX_WBITS)
+
+    def _write_palette(self, palette: list):
+        self._write_chunk('PLTE', b''.join([bytes(color) for color in palette]))
+
+    def _encode(self, data: bytes, height: int) -> bytes:
+        # data holds the unfiltered samples of height rows, one byte per sample below depth 8
+        with profiling.stage('imdata.filter', len(data)):
+            if self.depth < 8:
+                data = _pack_bits(data, height, self.depth)
+
+            data = _scanlines(data, height, self.bpp, self.filter)
+        return self._compress(data)
+
+    def _write_image(self, data: bytes):
+        self._write_chunk('IDAT', self._encode(data, self.height))
+
     @abstractmethod
     def _imdata(self):
         pass
@@ -101,14 +434,15 @@ class _pngEncoder(ABC):
         self.file.close()
 
     def make(self):
-        print(f'Making {self.filename}...')
+        profiling.log(f'Making {self.filename}...')
         start_time = time.time()
-        self.file = open(self.filename, 'wb')
-        self._signature()
-        self._header()
-        self._imdata()
-        self._end()
-        print(f'Finished cooking in {time.time() - start_time} seconds.')
+        with profiling.stage('png.make'):
+            self.file = open(self.filename, 'wb')
+            self._signature()
+            self._header()
+            self._imdata()
+            self._end()
+        profiling.log(f'Finished cooking in {time.time() - start_time} seconds.')
 
 
 class Grayscale(_pngEncoder):
@@ -119,7 +453,10 @@ class Grayscale(_pngEncoder):
     Parameters: \n
         filename - The name of the file to be created. Must _end with .png \n
         data - A list of lists containing the pixel values. Each value must be a non-negative integer less than 2^depth - 1. \n
-        depth - The bit depth of the image. Must be 8 or 16. \n
+               Can also be a NumPy array (or any buffer) of uint8 / uint16 values shaped H x W. \n
+        depth - The bit depth of the image. Must be 1, 2, 4, 8 or 16. \n
+        workers - The number of threads used for compression. \n
+        filter - The PNG row filter (Filter.NONE, SUB, UP, AVERAGE, PAETH), or Filter.ADAPTIVE to pick the best one for each row. Needs NumPy. \n
 
     Example: \n
         data = [
@@ -131,20 +468,17 @@ class Grayscale(_pngEncoder):
         Note the default depth is 8, so the highest value we can utilize is 2^8 - 1.
     """
 
-    def __init__(self, filename: str, data: list, depth: int = 8, compression: bool = False):
-        super().__init__(filename, data, depth = depth, color_type = Color.GRAYSCALE, compression = compression)
+    def __init__(self, filename: str, data: list, depth: int = 8, compression: bool = False, workers: int = 1, filter: Enum = Filter.NONE):
+        super().__init__(filename, data, depth = depth, color_type = Color.GRAYSCALE, compression = compression, workers = workers, filter = filter)
 
     def _imdata(self):
-        if self.depth == 8:
-            byte_size = 1
-        else:
-            byte_size = 2
+        with profiling.stage('imdata.pack'):
+            if self.buffer is not None:
+                data = _big_endian(self.buffer)
+            else:
+                data = _pack_rows(self.data, self.depth, self.channels)
 
-        data = b''
-        for row in self.data:
-                data += b'\x00' + b''.join([x.to_bytes(byte_size, 'big') for x in row])
-        
-        self._write_chunk('IDAT', zlib.compress(data, level = self.compression, wbits = zlib.MAX_WBITS))
+        self._write_image(data)
 
 class RGB(_pngEncoder):
     """
@@ -153,7 +487,10 @@ class RGB(_pngEncoder):
     Parameters: \n
         filename - The name of the file to be created. Must _end with .png \n
         data - A list of lists containing pixel tuples (r, g, b). Each value in the tuple must be a non-negative integer less than 2^depth - 1. \n
+               Can also be a NumPy array (or any buffer) of uint8 / uint16 values shaped H x W x 3. \n
         depth - The bit depth of the image. Must be 8 or 16. \n
+        workers - The number of threads used for compression. \n
+        filter - The PNG row filter (Filter.NONE, SUB, UP, AVERAGE, PAETH), or Filter.ADAPTIVE to pick the best one for each row. Needs NumPy. \n
 
     Example: \n
         data = [
@@ -163,24 +500,478 @@ class RGB(_pngEncoder):
         Will output a 2 x 3 RGB image with the pixel values given.
     """
 
-    def __init__(self, filename: str, data: list, depth: int = 8, compression: bool = False):
-        super().__init__(filename, data, depth = depth, color_type = Color.RGB, compression = compression)
+    def __init__(self, filename: str, data: list, depth: int = 8, compression: bool = False, workers: int = 1, filter: Enum = Filter.NONE):
+        super().__init__(filename, data, depth = depth, color_type = Color.RGB, compression = compression, workers = workers, filter = filter)
 
     def _imdata(self):
-        if self.depth == 8:
-            byte_size = 1
+        with profiling.stage('imdata.pack'):
+            if self.buffer is not None:
+                data = _big_endian(self.buffer)
+            else:
+                data = _pack_rows(self.data, self.depth, self.channels)
+
+        self._write_image(data)
+
+
+class Palette(_pngEncoder):
+    """
+    Creates an indexed-color PNG image from a list of palette indices. \n
+
+    Parameters: \n
+        filename - The name of the file to be created. Must _end with .png \n
+        data - A list of lists containing palette indices. Each index must be less than the number of colors. \n
+               Can also be a NumPy array (or any buffer) of uint8 values shaped H x W. \n
+        palette - A list of (r, g, b) tuples with 8 bit values. At most 2^depth colors. \n
+        depth - The bit depth of the indices. Must be 1, 2, 4 or 8. \n
+        workers - The number of threads used for compression. \n
+        filter - The PNG row filter (Filter.NONE, SUB, UP, AVERAGE, PAETH), or Filter.ADAPTIVE to pick the best one for each row. Needs NumPy. \n
+
+    Example: \n
+        data = [
+            [0, 1, 1],
+            [2, 0, 1]
+        ]
+        palette = [(0, 0, 0), (255, 255, 255), (255, 0, 0)]
+        Will output a 2 x 3 image with black, white and red pixels.
+        Three colors fit in 2 bit indices, so depth = 2 is enough.
+    """
+
+    def __init__(self, filename: str, data: list, palette: list, depth: int = 8, compression: bool = False, workers: int = 1, filter: Enum = Filter.NONE):
+        _check_palette(palette, depth)
+        super().__init__(filename, data, depth = depth, color_type = Color.PALETTE, compression = compression, workers = workers, filter = filter)
+        self.palette = palette
+
+    def _imdata(self):
+        with profiling.stage('imdata.pack'):
+            if self.buffer is not None:
+                data = self.buffer.tobytes()
+            else:
+                data = _pack_rows(self.data, self.depth, self.channels)
+            _check_indices(data, self.palette)
+
+        self._write_palette(self.palette)
+        self._write_image(data)
+
+
+def auto(filename: str, data: list, depth: int = 8, compression: bool = False, workers: int = 1, filter: Enum = Filter.NONE) -> _pngEncoder:
+    """
+    Returns the encoder with the smallest representation of a grayscale or RGB image, picked from its distinct pixel values. \n
+    Grayscale values that all sit on a coarser scale (e.g. only 0 and 255) are rescaled to 1, 2 or 4 bits,
+    and images with at most 256 distinct colors become indexed-color images with 1, 2, 4 or 8 bit indices. \n
+
+    Parameters: \n
+        filename - The name of the file to be created. Must _end with .png \n
+        data - The image, in any form Grayscale or RGB take. \n
+        depth - The bit depth of the values in data. Must be 8 or 16. \n
+
+    Example: \n
+        auto('rule30.png', data).make()
+        Will write data holding only 0 and 255 as a 1 bit grayscale image.
+    """
+
+    if np is not None:
+        pixels = np.asarray(data)
+        rgb = pixels.ndim == 3 and pixels.shape[2] == 3
+        if rgb and (pixels[..., 0] == pixels[..., 1]).all() and (pixels[..., 0] == pixels[..., 2]).all():
+            rgb = False
+        if pixels.ndim == 3 and not rgb:
+            pixels = pixels[..., 0]
+
+        keys = pixels.astype(np.int64)
+        if rgb:
+            keys = (keys[..., 0] << 32) | (keys[..., 1] << 16) | keys[..., 2]
+        distinct, inverse = np.unique(keys, return_inverse = True)
+        distinct = [(k >> 32, (k >> 16) & 0xffff, k & 0xffff) for k in distinct.tolist()] if rgb else distinct.tolist()
+
+        scaled = lambda scale, dtype: (pixels // scale).astype(dtype)
+        indices = lambda: inverse.reshape(pixels.shape[:2]).astype(np.uint8)
+    else:
+        try:
+            rows = memoryview(data).tolist()
+        except TypeError:
+            rows = data
+        rgb = not isinstance(rows[0][0], int)
+        if rgb:
+            rows = [[tuple(p) for p in row] for row in rows]
+        distinct = sorted(set(chain.from_iterable(rows)))
+        if rgb and all(r == g == b for r, g, b in distinct):
+            rgb = False
+            rows = [[p[0] for p in row] for row in rows]
+            distinct = [p[0] for p in distinct]
+
+        index = {value: i for i, value in enumerate(distinct)}
+        scaled = lambda scale, dtype: [[value // scale for value in row] for row in rows]
+        indices = lambda: [[index[value] for value in row] for row in rows]
+
+    options = dict(compression = compression, workers = workers, filter = filter)
+    max_value = 2**depth - 1
+
+    # Candidates are (bits per pixel, encoder), ties go to the first one since palettes cost a PLTE chunk
+    if rgb:
+        best = (3 * depth, lambda: RGB(filename, data, depth = depth, **options))
+    else:
+        for bits in [d for d in _DEPTHS[Color.GRAYSCALE] if d <= depth]:
+            scale = max_value // (2**bits - 1)
+            if all(value % scale == 0 for value in distinct):
+                dtype = None if np is None else np.uint16 if bits == 16 else np.uint8
+                best = (bits, lambda: Grayscale(filename, scaled(scale, dtype), depth = bits, **options))
+                break
+
+    # Palette colors are 8 bit, so 16 bit values must be exact multiples of 257
+    colors = distinct if rgb else [(value, value, value) for value in distinct]
+    color_scale = max_value // 255
+    if len(colors) <= 256 and all(c % color_scale == 0 for color in colors for c in color):
+        index_bits = next(d for d in _DEPTHS[Color.PALETTE] if len(colors) <= 2**d)
+        if index_bits < best[0]:
+            palette = [tuple(c // color_scale for c in color) for color in colors]
+            best = (index_bits, lambda: Palette(filename, indices(), palette, depth = index_bits, **options))
+
+    return best[1]()
+
+
+class Stream(_pngEncoder):
+    """
+    Writes a PNG one row at a time, so the whole image never has to be held in memory. \n
+    Rows are compressed as they arrive and written out in IDAT chunks of at most chunk_size bytes. \n
+
+    Parameters: \n
+        filename - The name of the file to be created. Must _end with .png \n
+        width - The width of the image in pixels. \n
+        height - The height of the image in pixels. \n
+        rows - An optional iterable (e.g. a generator) of rows, written out by make(). \n
+               Each row is a list of pixel values or indices (GRAYSCALE, PALETTE), a list of pixel tuples (RGB), or a uint8 / uint16 buffer. \n
+        depth - The bit depth of the image. 1, 2, 4, 8 or 16 depending on the color type, like the other encoders. \n
+        color_type - Color.GRAYSCALE, Color.RGB or Color.PALETTE. \n
+        palette - The list of (r, g, b) colors, for Color.PALETTE. \n
+        chunk_size - The maximum number of bytes in each IDAT chunk. \n
+        workers - The number of threads used for compression. \n
+        filter - The PNG row filter (Filter.NONE, SUB, UP, AVERAGE, PAETH), or Filter.ADAPTIVE to pick the best one for each row. Needs NumPy. \n
+
+    Example: \n
+        Stream('big.png', width, height, (make_row(y) for y in range(height))).make()
+
+        Or feeding the rows one at a time:
+
+        with Stream('big.png', width, height, color_type = Color.RGB) as png:
+            for y in range(height):
+                png.write(make_row(y))
+    """
+
+    def __init__(self, filename: str, width: int, height: int, rows = None, depth: int = 8, color_type: Enum = Color.GRAYSCALE, palette: list = None, compression: bool = False, chunk_size: int = 2**16, workers: int = 1, filter: Enum = Filter.NONE):
+
+        # No image data up front, the size is given instead
+        super().__init__(filename, None, depth = depth, color_type = color_type, compression = compression, workers = workers, filter = filter)
+
+        if color_type == Color.PALETTE or palette is not None:
+            _check_palette(palette or [], depth, color_type)
+
+        self.rows = rows
+        self.width = width
+        self.height = height
+        self.chunk_size = chunk_size
+        self.palette = palette
+        self.prior = b''
+        self.rows_written = 0
+        self.file = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
+
+    def _abort(self):
+        # After an error: closes the file and stops any compression threads, if the stream was opened at all
+        if self.file is None:
+            return
+        self.file.close()
+        if isinstance(self.compressor, _ParallelCompressor):
+            self.compressor.abort()
+
+    def _pack_row(self, row) -> bytes:
+        byte_size = 2 if self.depth == 16 else 1
+        row_size = self.width * self.channels * byte_size
+
+        try:
+            view = memoryview(row)
+        except TypeError:
+            view = None
+
+        if view is not None:
+            _check_format(view, self.depth)
+            data = _big_endian(view)
+        else:
+            data = _pack_rows([row], self.depth, self.channels)
+
+        if len(data) != row_size:
+            raise ValueError(f'Invalid row length. Expected {self.width} pixels.')
+
+        if self.color_type == Color.PALETTE.value:
+            _check_indices(data, self.palette)
+
+        if self.depth < 8:
+            data = _pack_bits(data, 1, self.depth)
+
+        return data
+
+    def _write_idat(self, final: bool = False):
+        while len(self.pending) >= self.chunk_size or (final and self.pending):
+            self._write_chunk('IDAT', bytes(self.pending[:self.chunk_size]))
+            del self.pending[:self.chunk_size]
+
+    def open(self):
+        self.file = open(self.filename, 'wb')
+        self._signature()
+        self._header()
+        if self.palette is not None:
+            self._write_palette(self.palette)
+        self.compressor = _compressor(self.compression, self.workers)
+        self.pending = bytearray()
+
+    def write(self, row):
+        '''Compresses one row and writes out any full IDAT chunks'''
+
+        with profiling.stage('imdata.pack'):
+            data = self._pack_row(row)
+        self.write_packed(data)
+
+    def write_packed(self, data: bytes):
+        '''Like write(), for a row that is already packed: big endian samples, and below depth 8
+        several pixels per byte with the first pixel in the highest bits, padded to a whole byte'''
+
+        if self.file is None:
+            self.open()
+
+        if self.rows_written == self.height:
+            raise ValueError(f'All {self.height} rows have already been written.')
+
+        if len(data) != (self.width * self.channels * self.depth + 7) // 8:
+            raise ValueError(f'Invalid row length. Expected {self.width} pixels.')
+
+        with profiling.stage('imdata.filter', len(data)):
+            line = _scanlines(data, 1, self.bpp, self.filter, self.prior)
+        with profiling.stage('imdata.deflate', len(line)):
+            self.pending += self.compressor.compress(line)
+        self.prior = data
+        self.rows_written += 1
+        self._write_idat()
+
+    def close(self):
+        '''Flushes the compressor and finishes the file'''
+
+        if self.rows_written != self.height:
+            self._abort()
+            raise ValueError(f'Expected {self.height} rows, but {self.rows_written} were written.')
+
+        with profiling.stage('imdata.deflate'):
+            self.pending += self.compressor.flush()
+        self._write_idat(final = True)
+        self._end()
+
+    def _imdata(self):
+        if self.rows is None:
+            raise ValueError('No rows to write. Pass rows to the constructor or feed them with write().')
+
+        for row in self.rows:
+            self.write(row)
+
+    def make(self):
+        profiling.log(f'Making {self.filename}...')
+        start_time = time.time()
+        with profiling.stage('png.make'), self:
+            self._imdata()
+        profiling.log(f'Finished cooking in {time.time() - start_time} seconds.')
+
+
+class Animation(_pngEncoder):
+    """
+    Creates an animated PNG (APNG) from a list of frames. \n
+    Only the rectangle that changed since the previous frame is stored, and it is drawn over the previous frame
+    (dispose op NONE, blend op SOURCE). Frames identical to the previous one just extend its delay, as long as fcTL's 16 bit delay can hold it. \n
+
+    Parameters: \n
+        filename - The name of the file to be created. Must _end with .png \n
+        frames - A list (or any iterable, e.g. a generator) of frames, each in a form Grayscale, RGB or Palette take. \n
+        fps - The frame rate. \n
+        depth - The bit depth of the frames. 1, 2, 4, 8 or 16 depending on the color type, like the other encoders. \n
+        color_type - Color.GRAYSCALE, Color.RGB or Color.PALETTE. \n
+        palette - The list of (r, g, b) colors, for Color.PALETTE. \n
+        loops - The number of times the animation plays, 0 loops forever. \n
+        filter - The PNG row filter (Filter.NONE, SUB, UP, AVERAGE, PAETH), or Filter.ADAPTIVE to pick the best one for each row. Needs NumPy. \n
+
+    Example: \n
+        frames = [ca.frame() for _ in range(100) if ca.update() is None]
+        Animation('life.png', frames, fps = 8, depth = 1).make()
+        Will output a 1 bit grayscale animation of 0 / 1 cells.
+    """
+
+    def __init__(self, filename: str, frames: list, fps: float = 24.0, depth: int = 8, color_type: Enum = Color.GRAYSCALE, palette: list = None, loops: int = 0, compression: bool = False, filter: Enum = Filter.NONE):
+
+        if color_type == Color.PALETTE or palette is not None:
+            _check_palette(palette or [], depth, color_type)
+
+        # The first frame sets the size of the animation
+        frames = iter(frames)
+        first = next(frames)
+        super().__init__(filename, first, depth = depth, color_type = color_type, compression = compression, filter = filter)
+
+        self.frames = chain([first], frames)
+        self.fps = fps
+        self.palette = palette
+        self.loops = loops
+        self.sequence = 0
+        self.num_frames = 0
+
+    def __str__(self) -> str:
+        return f'APNG Encoder: {self.filename}, {self.width} x {self.height}, {self.depth} bit, {self.color_type_str}, {self.fps} fps'
+
+    def _pack_frame(self, frame, pixel_size: int) -> bytes:
+        view = _as_buffer(frame, self.depth, self.channels)
+        if view is not None:
+            data = _big_endian(view)
         else:
-            byte_size = 2
+            data = _pack_rows(frame, self.depth, self.channels)
+
+        if len(data) != self.width * self.height * pixel_size:
+            raise ValueError(f'Invalid frame size. Every frame must be {self.width} x {self.height}.')
+
+        return data
 
-        data = b''
-        for row in self.data:
-            row_data = b'\x00'
-            for col in row:
-                r, g, b = col
-                row_data += r.to_bytes(byte_size, 'big') + g.to_bytes(byte_size, 'big') + b.to_bytes(byte_size, 'big')
-            data += row_data
+    def _actl(self):
+        self._write_chunk('acTL', self.num_frames.to_bytes(4, 'big') + self.loops.to_bytes(4, 'big'))
 
-        self._write_chunk('IDAT', zlib.compress(data, level = self.compression, wbits = zlib.MAX_WBITS))
+    def _delay(self, frames: int) -> Fraction:
+        # How long frames frames are shown, as fcTL's 16 bit fraction of seconds (the numerator can still be too big)
+        return (Fraction(frames) / Fraction(self.fps)).limit_denominator(65535)
+
+    def _write_frame(self, rect: tuple, data: bytes, frames: int):
+        x, y, width, height = rect
+        delay = self._delay(frames)
+        dispose_op = b'\x00'
+        blend_op = b'\x00'
+
+        fctl = self.sequence.to_bytes(4, 'big') + width.to_bytes(4, 'big') + height.to_bytes(4, 'big') + x.to_bytes(4, 'big') + y.to_bytes(4, 'big')
+        fctl += delay.numerator.to_bytes(2, 'big') + delay.denominator.to_bytes(2, 'big') + dispose_op + blend_op
+        self._write_chunk('fcTL', fctl)
+        self.sequence += 1
+
+        # The first frame doubles as the default image
+        if self.num_frames == 0:
+            self._write_chunk('IDAT', data)
+        else:
+            self._write_chunk('fdAT', self.sequence.to_bytes(4, 'big') + data)
+            self.sequence += 1
+
+        self.num_frames += 1
+
+    def _imdata(self):
+        pixel_size = self.channels * (2 if self.depth == 16 else 1)
+        stride = self.width * pixel_size
+        previous = None
+        pending = None
+
+        for frame in self.frames:
+            with profiling.stage('imdata.pack'):
+                current = self._pack_frame(frame, pixel_size)
+
+            with profiling.stage('frame.diff'):
+                if previous is None:
+                    rect = (0, 0, self.width, self.height)
+                else:
+                    rect = _changed(previous, current, self.height, pixel_size)
+
+            if rect is None and self._delay(pending[2] + 1).numerator < 2**16:
+                pending[2] += 1
+            else:
+                if rect is None:
+                    # The run's delay no longer fits in fcTL, so it goes on in a frame redrawing one unchanged pixel
+                    rect = (0, 0, 1, 1)
+                if pending is not None:
+                    self._write_frame(*pending)
+
+                x, y, width, height = rect
+                cropped = b''.join([current[row * stride + x * pixel_size:row * stride + (x + width) * pixel_size] for row in range(y, y + height)])
+                pending = [rect, self._encode(cropped, height), 1]
+
+            previous = current
+
+        self._write_frame(*pending)
+
+    def make(self):
+        profiling.log(f'Making {self.filename}...')
+        start_time = time.time()
+        with profiling.stage('png.make'):
+            self.file = open(self.filename, 'wb')
+            self._signature()
+            self._header()
+
+            # The frame count is only known at the end, so acTL is written now and patched afterwards
+            actl_position = self.file.tell()
+            self._actl()
+            if self.palette is not None:
+                self._write_palette(self.palette)
+
+            self._imdata()
+
+            self.file.seek(actl_position)
+            self._actl()
+            self.file.seek(0, 2)
+            self._end()
+        profiling.log(f'Finished cooking {self.num_frames} frames in {time.time() - start_time} seconds.')
+
+
+def _make_job(job: tuple) -> int:
+    # Runs in a worker process: renders the data if needed, then encodes and writes the file right there
+    filename, source, encoder, options = job
+    data = source() if callable(source) else source
+    image = encoder(filename, data, **options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        image.make()
+    return image.width * image.height
+
+def batch(jobs: list, encoder = auto, workers: int = None, **options) -> dict:
+    """
+    Renders and writes many images in a pool of processes. \n
+    Each worker calls the job's callable, encodes the result and writes the file itself,
+    so no pixel data is sent back to the caller. \n
+
+    Parameters: \n
+        jobs - A list of (filename, data) tuples. data is an image, or a callable returning one. \n
+               Callables are sent to the workers, so they must be picklable (module level functions, functools.partial). \n
+        encoder - Called as encoder(filename, data, **options) in the worker. Defaults to auto(). \n
+        workers - The number of processes. Defaults to the number of cores, 1 runs everything in this process. \n
+        options - Passed on to the encoder, e.g. compression = True. \n
+
+    Returns a dict with the number of images and pixels written, the seconds taken and the pixels per second. \n
+
+    Example: \n
+        jobs = [(f'rule{rule}.png', functools.partial(render, rule)) for rule in range(256)]
+        batch(jobs, workers = 8)
+    """
+
+    profiling.log(f'Making {len(jobs)} images...')
+    start_time = time.time()
+
+    tasks = [(filename, source, encoder, options) for filename, source in jobs]
+    if workers == 1:
+        pixels = sum(map(_make_job, tasks))
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            pixels = sum(executor.map(_make_job, tasks))
+
+    seconds = time.time() - start_time
+    stats = {
+        'images': len(jobs),
+        'pixels': pixels,
+        'seconds': seconds,
+        'pixels_per_second': pixels / seconds if seconds > 0 else 0.0
+    }
+    profiling.log(f'Finished cooking {len(jobs)} images in {seconds} seconds ({stats["pixels_per_second"] / 1e6:.2f} megapixels per second).')
+    return stats
 
 
 def test_gray(depth: int = 8):
@@ -199,6 +990,26 @@ def test_gray(depth: int = 8):
 
     Grayscale('testg.png', test_data, depth = depth).make()
 
+def test_pack_bits():
+    # Packed samples should read back the same, and samples too big for the depth should be rejected
+    for depth in (1, 2, 4):
+        for width in (1, 3, 8, 13):
+            samples = bytes((x * 7 + y) % 2**depth for y in range(3) for x in range(width))
+            packed = _pack_bits(samples, 3, depth)
+            row_bytes = (width * depth + 7) // 8
+            for y in range(3):
+                bits = int.from_bytes(packed[y * row_bytes:(y + 1) * row_bytes], 'big') >> (8 * row_bytes - width * depth)
+                assert [(bits >> (depth * (width - 1 - x))) & (2**depth - 1) for x in range(width)] == list(samples[y * width:(y + 1) * width])
+
+        # A leading 0 then a bad sample used to read as 0x... in base 16
+        for row in ([0, 2**depth, 1, 0], [0, 200, 1, 0], [255, 0, 0, 0]):
+            try:
+                _pack_bits(bytes(row), 1, depth)
+            except ValueError:
+                continue
+            raise AssertionError(f'{row} accepted at depth {depth}')
+    print('Bit packing checks out')
+
 def test_rgb(depth: int = 8):
     width = 204
     height = 204
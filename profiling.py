@@ -0,0 +1,170 @@
+# Stage timing for the PNG and MP4 encoders, using only the Python Standard Library
+#
+# The encoders time their stages (imdata.pack, imdata.filter, imdata.deflate, chunk.write,
+# frame.convert, frame.write, ...) through stage(). Nothing is collected by default: stage()
+# hands back a shared do-nothing timer and log() stays quiet, so the cost is one function call.
+#
+#   with profiling.collect(verbose = True) as profile:
+#       png.RGB('plot.png', data, compression = True).make()
+#   print(profile.report())
+#
+# Work done in other processes (pngenerator.batch, mp4generator.render_frames) is not collected.
+
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Set to True to print the encoders' progress messages without collecting anything
+VERBOSE = False
+
+# The active collectors, innermost last. Shared by every thread, so the mp4 writer thread reports too.
+_profiles = []
+
+
+class Stage:
+    '''Running totals for one named stage, with a histogram of latencies in power of two microsecond buckets'''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.seconds = 0.0
+        self.min = math.inf
+        self.max = 0.0
+        self.bytes = 0
+        self.histogram = {}
+
+    def add(self, seconds: float, nbytes: int = 0):
+        self.count += 1
+        self.seconds += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.bytes += nbytes
+
+        # Keyed by the bucket's upper bound: 2^k microseconds holds latencies in [2^(k-1), 2^k)
+        bucket = 2 ** max(0, math.frexp(seconds * 1e6)[1])
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+
+    def percentile(self, fraction: float) -> float:
+        '''Upper bound, in seconds, of the histogram bucket holding the given fraction of calls'''
+        seen = 0
+        for bucket in sorted(self.histogram):
+            seen += self.histogram[bucket]
+            if seen >= fraction * self.count:
+                return bucket / 1e6
+        return 0.0
+
+    def summary(self) -> dict:
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'mean': self.seconds / self.count if self.count else 0.0,
+            'min': self.min if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'bytes': self.bytes,
+            'bytes_per_second': self.bytes / self.seconds if self.seconds > 0 else 0.0,
+            'histogram_us': dict(sorted(self.histogram.items())),
+        }
+
+
+class Profile:
+    '''Collects stage timings. Usually made by collect(), but can be pushed with start() and popped with stop().
+
+    callback - Called as callback(name, seconds, nbytes) for every timed stage, e.g. to forward them to a metrics system.
+    verbose - Print the encoders' progress messages while collecting.'''
+
+    def __init__(self, callback = None, verbose: bool = False):
+        self.callback = callback
+        self.verbose = verbose
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.seconds = 0.0
+
+    def record(self, name: str, seconds: float, nbytes: int = 0):
+        with self.lock:
+            if name not in self.stages:
+                self.stages[name] = Stage(name)
+            self.stages[name].add(seconds, nbytes)
+
+        if self.callback is not None:
+            self.callback(name, seconds, nbytes)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        _profiles.append(self)
+        return self
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.start_time
+        _profiles.remove(self)
+
+    def summary(self) -> dict:
+        '''Every stage's totals as a plain dict, ready for json.dump'''
+        with self.lock:
+            return {name: stage.summary() for name, stage in self.stages.items()}
+
+    def report(self) -> str:
+        '''A table of the stages, slowest first'''
+        lines = [f"{'stage':16} {'count':>7} {'total s':>9} {'share':>6} {'mean ms':>9} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'MB/s':>9}"]
+        wall = self.seconds or time.perf_counter() - self.start_time
+
+        for name, stage in sorted(self.summary().items(), key = lambda item: -item[1]['seconds']):
+            lines.append(f"{name:16} {stage['count']:7} {stage['seconds']:9.4f} {stage['seconds'] / wall:6.1%} "
+                         f"{stage['mean'] * 1e3:9.3f} {stage['p50'] * 1e3:8.3f} {stage['p99'] * 1e3:8.3f} {stage['max'] * 1e3:8.3f} "
+                         f"{stage['bytes_per_second'] / 1e6:9.2f}")
+
+        lines.append(f'{len(self.stages)} stages over {wall:.4f} seconds (stages nest, so shares can add up to more than 100%)')
+        return '\n'.join(lines)
+
+
+class _Timer:
+    # Set bytes inside the with block when the size is only known at the end
+    __slots__ = ('profile', 'name', 'bytes', 'start')
+
+    def __init__(self, profile: Profile, name: str, nbytes: int):
+        self.profile = profile
+        self.name = name
+        self.bytes = nbytes
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.record(self.name, time.perf_counter() - self.start, self.bytes)
+
+
+class _NullTimer:
+    __slots__ = ('bytes',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+
+def stage(name: str, nbytes: int = 0):
+    '''Times a with block as the named stage of the innermost active collector, if there is one'''
+    if not _profiles:
+        return _NULL_TIMER
+    return _Timer(_profiles[-1], name, nbytes)
+
+def log(message: str):
+    '''Prints a progress message when VERBOSE is set or the active collector is verbose'''
+    if VERBOSE or (_profiles and _profiles[-1].verbose):
+        print(message)
+
+@contextmanager
+def collect(callback = None, verbose: bool = False):
+    '''Collects stage timings for everything encoded inside the with block'''
+    profile = Profile(callback, verbose).start()
+    try:
+        yield profile
+    finally:
+        profile.stop()
@@ -0,0 +1,91 @@
+# Adaptive rasterizer for implicit curves, using NumPy
+#
+# Only the pixels near the curve need f. f is sampled on the corners of a coarse grid of cells,
+# and only the cells that might hold a pixel inside the band are split in four, level by level,
+# down to a few pixels, where every pixel is evaluated. The evaluation count grows with the length
+# of the curve instead of the area of the image.
+#
+# A cell is split when its corner values, widened by their spread (max - min) on both sides, reach
+# the band, or when a corner is NaN or infinite. The widening catches curvature between the corners,
+# but a feature that fits between the corners of a coarse cell without moving them (a tiny closed loop,
+# a narrow spike) can still be missed: raise min_samples for those.
+
+import numpy as np
+
+
+def _mark(mask: np.ndarray, px: np.ndarray, py: np.ndarray, values: np.ndarray, low: float, high: float):
+    with np.errstate(invalid='ignore'):
+        hit = ((values >= low) & (values <= high)) | np.isnan(values)
+    mask[py[hit], px[hit]] = True
+
+def rasterize(f, width: int, height: int, low: float, high: float, min_samples: int = 64, min_cell: int = 2, max_depth: int = None, stats: dict = None) -> np.ndarray:
+    '''Returns a bool array, height x width, True where low <= f(px, py) <= high or f is NaN.
+
+    f - Takes float arrays of pixel columns px and rows py, returns an array of values.
+    min_samples - The coarse grid has at least this many cells across the shorter side.
+    min_cell - Cells this size (in pixels) or smaller are evaluated at every pixel.
+    max_depth - Stop splitting after this many levels, and evaluate what is left at every pixel.
+    stats - If given, filled with the number of evaluations and levels.'''
+
+    mask = np.zeros((height, width), dtype=bool)
+    evaluations = 0
+
+    def evaluate(px: np.ndarray, py: np.ndarray) -> np.ndarray:
+        nonlocal evaluations
+        evaluations += len(px)
+        with np.errstate(all='ignore'):
+            values = f(px.astype(np.float64), py.astype(np.float64))
+        return np.broadcast_to(values, px.shape).astype(np.float64)
+
+    # The largest power of two cell that still gives min_samples cells across
+    size = 1
+    while min(width, height) // (size * 2) >= min_samples:
+        size *= 2
+
+    columns = -(-width // size)
+    cy, cx = np.divmod(np.arange(columns * -(-height // size)), columns)
+    depth = 0
+
+    while size > min_cell and (max_depth is None or depth < max_depth):
+        # Neighbouring cells share corners, so mark the corners on the lattice of this level and evaluate each once
+        lattice = np.zeros((-(-height // size) + 1, -(-width // size) + 1), dtype=bool)
+        for dy, dx in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            lattice[cy + dy, cx + dx] = True
+
+        points = np.flatnonzero(lattice)
+        ly, lx = np.divmod(points, lattice.shape[1])
+        px, py = np.minimum(lx * size, width - 1), np.minimum(ly * size, height - 1)
+        grid = np.empty(lattice.shape)
+        grid.flat[points] = values = evaluate(px, py)
+        _mark(mask, px, py, values, low, high)
+
+        corners = np.stack([grid[cy + dy, cx + dx] for dy, dx in ((0, 0), (0, 1), (1, 0), (1, 1))])
+        lowest, highest = corners.min(axis=0), corners.max(axis=0)
+        spread = highest - lowest
+
+        # NaN (and inf - inf) fails both comparisons, so those cells are split too
+        with np.errstate(invalid='ignore'):
+            split = ~((highest + spread < low) | (lowest - spread > high))
+
+        size //= 2
+        cx = (2 * cx[split, None] + np.array([0, 1, 0, 1])).ravel()
+        cy = (2 * cy[split, None] + np.array([0, 0, 1, 1])).ravel()
+        inside = (cx * size < width) & (cy * size < height)
+        cx, cy = cx[inside], cy[inside]
+        depth += 1
+
+    # Every pixel of the cells left. Corners were marked as they were evaluated,
+    # so each cell only needs its own pixels, not the ones it shares with the next cells over.
+    offsets = np.arange(size)
+    px = cx[:, None, None] * size + offsets[None, None, :]
+    py = cy[:, None, None] * size + offsets[None, :, None]
+    px, py = np.broadcast_arrays(px, py)
+    keep = (px < width) & (py < height)
+    px, py = px[keep], py[keep]
+
+    _mark(mask, px, py, evaluate(px, py), low, high)
+
+    if stats is not None:
+        stats['evaluations'] = evaluations
+        stats['levels'] = depth
+    return mask
@@ -0,0 +1,160 @@
+# Disk cache of rendered tiles, using NumPy
+#
+# The plane is cut into square tiles of tile_size pixels on a global pixel lattice for each resolution,
+# so two viewports at the same resolution (and the same sub-pixel offset) share their tiles.
+# Panning only renders the tiles that come into view, and going back to a resolution that was
+# rendered before finds its tiles again. Tiles are .npy files named by a hash of the key (what is
+# rendered), the resolution, the sub-pixel offset and the tile position. The least recently used
+# tiles are deleted once the directory holds more than max_bytes.
+#
+#   cache = TileCache('.tilecache')
+#   key = source_key(f, color, BIT_DEPTH)
+#   image = cache.render(render_tile, key, X_MIN, Y_MAX, width, height, RESOLUTION, y_sign = -1)
+
+import hashlib
+import inspect
+import math
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+def source_key(*parts) -> str:
+    '''A hash of everything that decides what a tile looks like.
+    Functions are hashed by their source (or bytecode when the source is not available), anything else by repr.
+    Pass the globals the functions read too (e.g. BIT_DEPTH), they are not followed.'''
+
+    pieces = []
+    for part in parts:
+        if callable(part):
+            try:
+                pieces.append(inspect.getsource(part))
+            except (OSError, TypeError):
+                code = part.__code__
+                pieces.append(code.co_code.hex() + repr(code.co_consts))
+        else:
+            pieces.append(repr(part))
+
+    return hashlib.sha256('\0'.join(pieces).encode()).hexdigest()
+
+
+class TileCache:
+
+    def __init__(self, directory: str, max_bytes: int = 2**30, tile_size: int = 256):
+        '''directory - Where the tiles are kept, made if missing.
+        max_bytes - The tiles on disk are trimmed to this size, least recently used first.
+        tile_size - The side of a tile in pixels.'''
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.tile_size = tile_size
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Tile name -> size, least recently used first. Use is kept across runs in the files' mtime.
+        tiles = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                tiles.append((stat.st_mtime, entry.name, stat.st_size))
+
+        self.tiles = OrderedDict((name, size) for _, name, size in sorted(tiles))
+        self.bytes = sum(self.tiles.values())
+        self._trim()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _load(self, name: str):
+        if name not in self.tiles:
+            return None
+
+        try:
+            tile = np.load(self._path(name))
+        except (OSError, ValueError):
+            # Deleted or half written by someone else, render it again
+            self.bytes -= self.tiles.pop(name)
+            return None
+
+        self.tiles.move_to_end(name)
+        os.utime(self._path(name))
+        return tile
+
+    def _store(self, name: str, tile: np.ndarray):
+        # Written next to its final name and moved in place, so a crash never leaves a broken tile
+        temporary = self._path(name + '.tmp')
+        with open(temporary, 'wb') as file:
+            np.save(file, tile)
+        os.replace(temporary, self._path(name))
+
+        if name in self.tiles:
+            self.bytes -= self.tiles.pop(name)
+        self.tiles[name] = os.path.getsize(self._path(name))
+        self.bytes += self.tiles[name]
+        self._trim()
+
+    def _trim(self):
+        # The newest tile always stays, even when it alone is over max_bytes
+        while self.bytes > self.max_bytes and len(self.tiles) > 1:
+            oldest, size = self.tiles.popitem(last=False)
+            self.bytes -= size
+            try:
+                os.remove(self._path(oldest))
+            except FileNotFoundError:
+                pass
+
+    def tile(self, render_tile, key: str, column: int, row: int, resolution: float, phase: tuple = (0.0, 0.0), y_sign: int = 1) -> np.ndarray:
+        '''One tile, from disk or rendered with render_tile(x, y) and stored.
+        render_tile gets the tile's pixel coordinates as two 1D arrays and returns an array shaped len(y) x len(x) (x ...).'''
+
+        # Floats throughout, so 2 and 2.0 name the same tile
+        position = (key, float(resolution), tuple(map(float, phase)), y_sign, self.tile_size, column, row)
+        name = hashlib.sha256(repr(position).encode()).hexdigest() + '.npy'
+        tile = self._load(name)
+        if tile is not None:
+            self.hits += 1
+            return tile
+
+        self.misses += 1
+        pixels = np.arange(self.tile_size)
+        x = (column * self.tile_size + pixels + phase[0]) / resolution
+        # + 0.0 turns -0.0 into 0.0, which matters on branch cuts (e.g. cmath.log on the negative real axis)
+        y = y_sign * (row * self.tile_size + pixels + phase[1]) / resolution + 0.0
+        tile = np.asarray(render_tile(x, y))
+        self._store(name, tile)
+        return tile
+
+    def bands(self, render_tile, key: str, x_min: float, y_start: float, width: int, height: int, resolution: float, y_sign: int = 1):
+        '''Yields the image one band of tiles at a time, top to bottom.
+        Pixel (px, py) is at x = x_min + px / resolution and y = y_start + y_sign * py / resolution,
+        so y_sign = -1 puts y_start (e.g. Y_MAX) on the top row.'''
+
+        size = self.tile_size
+
+        # Where the viewport sits on the lattice: a whole number of pixels plus a fraction, which becomes part of the key
+        # (rounded, so viewports that only differ by float error share tiles)
+        start_x = round(x_min * resolution, 6)
+        start_y = round(y_sign * y_start * resolution, 6)
+        origin_x, origin_y = math.floor(start_x), math.floor(start_y)
+        phase = (float(round(start_x - origin_x, 6)), float(round(start_y - origin_y, 6)))
+
+        columns = range(origin_x // size, (origin_x + width - 1) // size + 1)
+        for row in range(origin_y // size, (origin_y + height - 1) // size + 1):
+            band = np.concatenate([self.tile(render_tile, key, column, row, resolution, phase, y_sign) for column in columns], axis=1)
+
+            left = origin_x - columns[0] * size
+            top = max(0, origin_y - row * size)
+            bottom = min(size, origin_y + height - row * size)
+            yield band[top:bottom, left:left + width]
+
+    def rows(self, *args, **kwargs):
+        '''The rows of bands(), one at a time, e.g. for pngenerator.Stream'''
+        for band in self.bands(*args, **kwargs):
+            yield from band
+
+    def render(self, *args, **kwargs) -> np.ndarray:
+        '''The whole image of bands() as one array'''
+        return np.concatenate(list(self.bands(*args, **kwargs)))